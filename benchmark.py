@@ -0,0 +1,332 @@
+###############################################################################
+# Benchmarks
+#
+# Times the hot paths of training and testing on synthetic corpora and on the
+# bundled data/wikitext-2, at each combination of --vocab and --nhid:
+#
+#   tokenize          SentenceCorpus tokenization of train + valid
+#   train_step        BPTTIterator batches through forward, backward, clipping
+#                     and an SGD step, as in main.train
+#   evaluate          the validation loop of main.evaluate
+#   test_startup      main.py --test on a one-sentence test file (fixed cost of
+#                     imports, vocabulary and model loading)
+#   test_sentences    main.py --test (sentence-level losses)
+#   test_words        main.py --test --words --nhallucinate 0
+#   test_hallucinate  main.py --test --words --nhallucinate N --complexn K
+#   generate          generate.py sampling
+#
+# Models are untrained, which does not change their speed. The bundled
+# wikitext-2 has no train.txt, so its valid.txt doubles as training data. The test and
+# generate cases run the real scripts in a fresh process and are timed end
+# to end; subtract test_startup to see the per-sentence work. Each case runs
+# --repeat times and the median is reported.
+#
+#   python benchmark.py --out base.json
+#   python benchmark.py --out new.json --baseline base.json --threshold 0.1
+#   python benchmark.py --compare new.json --baseline base.json
+#
+# With --baseline, any case more than --threshold slower than in the baseline
+# is reported as a regression and the exit status is 1.
+###############################################################################
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+parser = argparse.ArgumentParser(description='Benchmark tokenization, training, evaluation and testing')
+parser.add_argument('--vocab', type=str, default='10000,50000',
+                    help='comma-separated vocabulary sizes of the synthetic corpora')
+parser.add_argument('--nhid', type=str, default='200,650',
+                    help='comma-separated hidden (and embedding) sizes')
+parser.add_argument('--wikitext', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                 'data', 'wikitext-2'),
+                    help='bundled corpus to benchmark as well (empty to skip)')
+parser.add_argument('--tokens', type=int, default=200000,
+                    help='number of training tokens in each synthetic corpus')
+parser.add_argument('--batch_size', type=int, default=20,
+                    help='training batch size')
+parser.add_argument('--bptt', type=int, default=35,
+                    help='sequence length')
+parser.add_argument('--loss_chunk', type=int, default=0,
+                    help='positions decoded at a time by the train_step and evaluate losses (0 = all)')
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'],
+                    help='precision of the training, evaluation and test cases (as main.py --precision)')
+parser.add_argument('--train_batches', type=int, default=20,
+                    help='number of timed training batches')
+parser.add_argument('--eval_batches', type=int, default=50,
+                    help='number of timed validation batches')
+parser.add_argument('--test_sentences', type=int, default=200,
+                    help='number of test file lines scored by the test cases')
+parser.add_argument('--test_batch_size', type=int, default=1,
+                    help='main.py --test_batch_size')
+parser.add_argument('--nhallucinate', type=int, default=2,
+                    help='lookahead depth of the test_hallucinate case')
+parser.add_argument('--complexn', type=int, default=100,
+                    help='lookahead beam of the test_hallucinate case')
+parser.add_argument('--gen_words', type=int, default=200,
+                    help='number of words sampled by the generate case')
+parser.add_argument('--workers', type=int, default=1,
+                    help='tokenizer processes')
+parser.add_argument('--segmenter', type=str, default='punkt', choices=['punkt', 'regex', 'line'],
+                    help='sentence segmenter used by tokenization and testing')
+parser.add_argument('--threads', type=int, default=0,
+                    help='torch threads (0 = torch default)')
+parser.add_argument('--repeat', type=int, default=3,
+                    help='runs per case; the median is reported')
+parser.add_argument('--cases', type=str, default=None,
+                    help='comma-separated cases to run (default: all)')
+parser.add_argument('--seed', type=int, default=1111,
+                    help='random seed')
+parser.add_argument('--out', type=str, default='benchmark.json',
+                    help='path to save the results')
+parser.add_argument('--baseline', type=str, default=None,
+                    help='results of an earlier run to compare against')
+parser.add_argument('--threshold', type=float, default=0.1,
+                    help='slowdown relative to the baseline reported as a regression')
+parser.add_argument('--compare', type=str, default=None,
+                    help='compare these saved results with --baseline instead of running')
+parser.add_argument('--keep', action='store_true',
+                    help='keep the generated corpora and models')
+
+CASES = ['tokenize', 'train_step', 'evaluate', 'test_startup', 'test_sentences',
+         'test_words', 'test_hallucinate', 'generate']
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2
+
+def compare(results, baseline, threshold):
+    """Prints the change of every case shared with baseline; returns the names of the regressions."""
+    regressions = []
+    print('{:50s} {:>10s} {:>10s} {:>8s}'.format('case', 'base (s)', 'new (s)', 'change'))
+    for name in sorted(results):
+        if name not in baseline:
+            print('{:50s} {:>10s} {:10.4f}'.format(name, '-', results[name]['seconds']))
+            continue
+        old, new = baseline[name]['seconds'], results[name]['seconds']
+        change = new / old - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('{:50s} {:10.4f} {:10.4f} {:+7.1f}%{}'.format(name, old, new, 100 * change, flag))
+    for name in sorted(set(baseline) - set(results)):
+        print('{:50s} {:10.4f} {:>10s}'.format(name, baseline[name]['seconds'], '-'))
+    print('{} of {} shared cases more than {:.0f}% slower than the baseline'.format(
+        len(regressions), len(set(results) & set(baseline)), 100 * threshold))
+    return regressions
+
+def load_results(path):
+    with open(path, 'r') as f:
+        return json.load(f)['results']
+
+args = parser.parse_args()
+if args.compare:
+    if not args.baseline:
+        parser.error('--compare needs --baseline')
+    sys.exit(1 if compare(load_results(args.compare), load_results(args.baseline), args.threshold) else 0)
+cases = args.cases.split(',') if args.cases else CASES
+for case in cases:
+    if case not in CASES:
+        parser.error('unknown case {!r} (choose from {})'.format(case, ', '.join(CASES)))
+
+# torch takes seconds to import, so --help and --compare return first
+import numpy as np
+import torch
+
+import data
+import model
+import checkpoint
+import complexity
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def write_synthetic(path, vocab, ntokens, rng):
+    ## writes train/valid/test files of Zipf-distributed words w0 ... w{vocab-1}
+    ## every word appears in train, so the vocabulary has vocab words plus <eos>
+    words = np.array(['w{}'.format(i) for i in range(vocab)])
+    probs = 1. / np.arange(1, vocab + 1)
+    probs /= probs.sum()
+    os.makedirs(path)
+    for fname, n in [('train.txt', ntokens), ('valid.txt', ntokens // 10), ('test.txt', ntokens // 10)]:
+        with open(os.path.join(path, fname), 'w') as f:
+            if fname == 'train.txt':
+                for start in range(0, vocab, 20):
+                    f.write(' '.join(words[start:start+20]) + ' .\n')
+            written = 0
+            while written < n:
+                length = int(rng.integers(5, 30))
+                f.write(' '.join(words[rng.choice(vocab, length, p=probs)]) + ' .\n')
+                written += length + 1
+
+def write_test_files(src, dest, nlines):
+    ## copies the first nlines non-blank lines of the test set, and just the first one
+    with open(os.path.join(src, 'test.txt'), 'r') as f:
+        lines = [line for line in f if line.strip()][:nlines]
+    with open(os.path.join(dest, 'bench_test.txt'), 'w') as f:
+        f.writelines(lines)
+    with open(os.path.join(dest, 'bench_one.txt'), 'w') as f:
+        f.writelines(lines[:1])
+
+def batchify(source, bsz):
+    nbatch = source.size(0) // bsz
+    return source.narrow(0, 0, nbatch * bsz).view(bsz, -1).t().contiguous()
+
+def timed(func, repeat):
+    ## returns the run times of func, after one untimed warm-up call
+    func()
+    runs = []
+    for r in range(repeat):
+        start = time.perf_counter()
+        func()
+        runs.append(time.perf_counter() - start)
+    return runs
+
+def autocast():
+    return torch.autocast('cpu', dtype=torch.bfloat16, enabled=args.precision == 'bf16')
+
+def train_steps(net, optimizer, train_data):
+    net.train()
+    hidden = net.init_hidden(train_data.size(1))
+    with contextlib.closing(iter(data.BPTTIterator(train_data, args.bptt))) as batches:
+        for batch, (source, targets) in enumerate(batches):
+            if batch == args.train_batches:
+                break
+            hidden = complexity.map_hidden(lambda h: h.detach(), hidden)
+            optimizer.zero_grad(set_to_none=True)
+            with autocast():
+                loss, hidden = net(source, hidden, targets.view_as(source))
+            loss.mean().backward()
+            torch.nn.utils.clip_grad_norm_(net.parameters(), 0.25, foreach=True)
+            optimizer.step()
+
+@torch.inference_mode()
+def evaluate(net, val_data):
+    net.eval()
+    total_loss = 0
+    hidden = net.init_hidden(val_data.size(1))
+    with contextlib.closing(iter(data.BPTTIterator(val_data, args.bptt))) as batches:
+        for batch, (source, targets) in enumerate(batches):
+            if batch == args.eval_batches:
+                break
+            with autocast():
+                loss, hidden = net(source, hidden, targets.view_as(source))
+            total_loss += len(source) * loss.mean()
+    return total_loss.item()
+
+def run_script(argv):
+    ## runs a script of this repo in a fresh process and returns its wall time
+    start = time.perf_counter()
+    subprocess.run([sys.executable] + argv, cwd=HERE, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def record(results, name, runs, work=None, unit=None, **info):
+    entry = {'seconds': median(runs), 'runs': runs}
+    if work is not None:
+        entry[unit] = work / entry['seconds']
+    entry.update(info)
+    results[name] = entry
+    line = '| {:50s} | {:9.4f}s'.format(name, entry['seconds'])
+    if work is not None:
+        line += ' | {:12.1f} {}'.format(entry[unit], unit)
+    print(line)
+    sys.stdout.flush()
+
+def benchmark_corpus(results, label, path, workdir):
+    lm_data = os.path.join(workdir, label + '.vocab')
+    # the bundled wikitext-2 ships without its training set
+    trainfname = 'train.txt' if os.path.exists(os.path.join(path, 'train.txt')) else 'valid.txt'
+    corpus = None
+    if 'tokenize' in cases:
+        runs = []
+        for r in range(args.repeat):
+            start = time.perf_counter()
+            corpus = data.SentenceCorpus(path, lm_data, trainfname=trainfname, workers=args.workers,
+                                         segmenter=args.segmenter)
+            runs.append(time.perf_counter() - start)
+        record(results, 'tokenize/' + label, runs, len(corpus.train) + len(corpus.valid), 'tokens_per_s',
+               vocab=len(corpus.dictionary))
+    else:
+        corpus = data.SentenceCorpus(path, lm_data, trainfname=trainfname, workers=args.workers,
+                                     segmenter=args.segmenter)
+    ntokens = len(corpus.dictionary)
+    write_test_files(path, workdir, args.test_sentences)
+    for nhid in [int(n) for n in args.nhid.split(',')]:
+        name = '{}-h{}'.format(label, nhid)
+        torch.manual_seed(args.seed)
+        net = model.RNNModel('LSTM', ntokens, nhid, nhid, 2, 0.2, True, loss_chunk=args.loss_chunk)
+        if 'train_step' in cases:
+            optimizer = torch.optim.SGD(net.parameters(), lr=20, foreach=True)
+            train_data = batchify(corpus.train, args.batch_size)
+            nbatches = min(args.train_batches, (train_data.size(0) - 1) // args.bptt)
+            runs = timed(lambda: train_steps(net, optimizer, train_data), args.repeat)
+            record(results, 'train_step/' + name, [r / nbatches for r in runs],
+                   args.batch_size * args.bptt, 'tokens_per_s', vocab=ntokens, nhid=nhid)
+        if 'evaluate' in cases:
+            val_data = batchify(corpus.valid, 10)
+            ntimed = min(val_data.size(0) - 1, args.eval_batches * args.bptt) * val_data.size(1)
+            runs = timed(lambda: evaluate(net, val_data), args.repeat)
+            record(results, 'evaluate/' + name, runs, ntimed, 'tokens_per_s', vocab=ntokens, nhid=nhid)
+        save = os.path.join(workdir, name + '.pt')
+        checkpoint.save(save, net)
+        test = ['main.py', '--test', '--data', workdir, '--lm_data', lm_data, '--save', save,
+                '--test_batch_size', str(args.test_batch_size), '--segmenter', args.segmenter,
+                '--precision', args.precision,
+                '--outf', os.devnull]
+        test_cases = [('test_startup', ['--testfname', 'bench_one.txt']),
+                      ('test_sentences', ['--testfname', 'bench_test.txt']),
+                      ('test_words', ['--testfname', 'bench_test.txt', '--words', '--nhallucinate', '0']),
+                      ('test_hallucinate', ['--testfname', 'bench_test.txt', '--words',
+                                            '--nhallucinate', str(args.nhallucinate),
+                                            '--complexn', str(args.complexn)])]
+        for case, extra in test_cases:
+            if case in cases:
+                runs = [run_script(test + extra) for r in range(args.repeat)]
+                record(results, case + '/' + name, runs, vocab=ntokens, nhid=nhid)
+        if 'generate' in cases:
+            argv = ['generate.py', '--checkpoint', save, '--lm_data', lm_data,
+                    '--words', str(args.gen_words), '--outf', os.devnull]
+            runs = [run_script(argv) for r in range(args.repeat)]
+            record(results, 'generate/' + name, runs, vocab=ntokens, nhid=nhid)
+
+if args.threads > 0:
+    torch.set_num_threads(args.threads)
+rng = np.random.default_rng(args.seed)
+workdir = tempfile.mkdtemp(prefix='lm-benchmark-')
+results = {}
+try:
+    corpora = []
+    for vocab in [int(v) for v in args.vocab.split(',') if v]:
+        label = 'synth-v{}'.format(vocab)
+        write_synthetic(os.path.join(workdir, label), vocab, args.tokens, rng)
+        corpora.append((label, os.path.join(workdir, label)))
+    if args.wikitext:
+        corpora.append((os.path.basename(os.path.normpath(args.wikitext)), args.wikitext))
+    for label, path in corpora:
+        benchmark_corpus(results, label, path, workdir)
+finally:
+    if args.keep:
+        sys.stderr.write('Benchmark files kept in ' + workdir + '\n')
+    else:
+        shutil.rmtree(workdir)
+meta = {'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'threads': torch.get_num_threads(),
+        'args': vars(args)}
+with open(args.out, 'w') as f:
+    json.dump({'meta': meta, 'results': results}, f, indent=1, sort_keys=True)
+sys.stderr.write('Results saved to ' + args.out + '\n')
+if args.baseline:
+    sys.exit(1 if compare(results, load_results(args.baseline), args.threshold) else 0)
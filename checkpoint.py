@@ -0,0 +1,94 @@
+###############################################################################
+# Checkpoints
+#
+# A checkpoint is a plain dict of tensors and Python values: the model's
+# constructor arguments ('config') and state_dict ('model'), plus whatever
+# training state the caller adds (optimizer and scheduler state, epoch,
+# learning rate, RNG state, ...). It loads with torch.load(weights_only=True),
+# so no code is unpickled, and files are written to a temporary name and
+# renamed into place, so a run killed mid-save leaves the previous file.
+# Whole pickled models written by older versions of main.py still load.
+###############################################################################
+
+import os
+import pickle
+import random
+import numpy as np
+import torch
+import torch.nn as nn
+
+import model
+
+FORMAT_VERSION = 1
+
+def model_config(net):
+    """Returns the RNNModel constructor arguments that rebuild net."""
+    adaptive = isinstance(net.decoder, model.AdaptiveSoftmax)
+    return {'rnn_type': net.rnn_type,
+            'ntoken': net.encoder.num_embeddings,
+            'ninp': net.encoder.embedding_dim,
+            'nhid': net.nhid,
+            'nlayers': net.nlayers,
+            'dropout': net.drop.p,
+            'tie_weights': net.decoder.weight is net.encoder.weight,
+            'cutoffs': net.decoder.cutoffs[:-1] if adaptive else None}
+
+def build_model(config):
+    """Returns an untrained RNNModel with the given constructor arguments."""
+    order = None
+    if config['cutoffs']:
+        # placeholder; the real frequency order is a buffer in the state_dict
+        order = torch.arange(config['ntoken'])
+    return model.RNNModel(order=order, **config)
+
+def rng_state():
+    """Returns the state of every random number generator training touches."""
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {'torch': torch.get_rng_state(),
+             'numpy': (name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian),
+             'python': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    """Restores random number generators from rng_state()."""
+    torch.set_rng_state(state['torch'])
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    random.setstate(state['python'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def save(path, net, **state):
+    """Atomically writes a checkpoint of net plus the given training state."""
+    ckpt = {'version': FORMAT_VERSION,
+            'config': model_config(net),
+            'model': net.state_dict()}
+    ckpt.update(state)
+    tmp = path + '.tmp' + str(os.getpid())
+    with open(tmp, 'wb') as f:
+        torch.save(ckpt, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def load(path, map_location=None):
+    """Loads a checkpoint written by save() or a whole pickled model.
+
+    Returns the model and the checkpoint dict (empty for old pickles).
+    """
+    try:
+        ckpt = torch.load(path, map_location=map_location, weights_only=True)
+    except pickle.UnpicklingError:
+        # a whole model pickled by an older version of main.py
+        ckpt = torch.load(path, map_location=map_location, weights_only=False)
+    if isinstance(ckpt, nn.Module):
+        if isinstance(ckpt, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+            ckpt = ckpt.module
+        return ckpt, {}
+    net = build_model(ckpt['config'])
+    net.load_state_dict(ckpt['model'])
+    if map_location is not None:
+        net.to(map_location)
+    return net, ckpt
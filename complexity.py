@@ -0,0 +1,196 @@
+###############################################################################
+# Word-level complexity measures
+#
+# Each function works on a whole matrix of output scores at once, with one
+# row per position and one column per vocabulary item, so a sentence costs a
+# handful of batched kernels instead of one softmax per word.
+###############################################################################
+
+import torch
+import torch.nn as nn
+
+# bytes of each (positions x vocabulary) score matrix of a rollout step
+ROLLOUT_BUDGET = 1 << 28
+
+def beam(o, complexn):
+    """Keeps the complexn best scores in each row of o, setting the rest to -inf.
+
+    complexn <= 0 or >= the vocabulary size keeps every score.
+    """
+    if complexn <= 0 or complexn >= o.size(-1):
+        return o
+    beamk, beamix = torch.topk(o, complexn, -1)
+    return torch.full_like(o, float('-inf')).scatter(-1, beamix, beamk)
+
+def top_candidates(o, k=0, p=1.0):
+    """Returns the scores and indices of the best candidates in each row of o.
+
+    Keeps the k best scores of each row (k <= 0 keeps all of them), then
+    the fewest of those whose probability under a softmax over the kept
+    scores reaches p (nucleus filtering). Candidates come best first, and
+    ones the nucleus drops get a score of -inf. The nucleus is usually a small
+    part of the vocabulary, so it is searched for with topk over 64, 256,
+    ... candidates, falling back to sorting whole rows once a quarter of
+    the row is needed.
+    """
+    pool, poolix = o, None
+    if 0 < k < o.size(-1):
+        pool, poolix = torch.topk(o, k, -1)
+    if p >= 1:
+        return torch.sort(pool, -1, descending=True) if poolix is None else (pool, poolix)
+    logz = torch.logsumexp(pool, -1, keepdim=True)
+    n = 64
+    while True:
+        if 4 * n > pool.size(-1):
+            topk, topix = torch.sort(pool, -1, descending=True)
+            break
+        topk, topix = torch.topk(pool, n, -1)
+        if bool(((topk - logz).exp().sum(-1) >= p).all()):
+            break
+        n *= 4
+    probs = (topk - logz).exp()
+    # drop a candidate once the mass of the better ones already reaches p
+    topk = topk.masked_fill((probs.cumsum(-1) - probs) >= p, float('-inf'))
+    if poolix is not None:
+        topix = poolix.gather(-1, topix)
+    return topk, topix
+
+def log_probs(o, complexn=0):
+    """Returns the log probabilities of each row of o, restricted to its beam."""
+    return nn.functional.log_softmax(beam(o, complexn), dim=-1)
+
+def entropy(logprobs):
+    """Returns the entropy of each row of a log probability matrix."""
+    probs = logprobs.exp()
+    # 0 * log 0 is nan; it contributes nothing to the entropy
+    prod = (probs * logprobs).masked_fill(probs == 0, 0)
+    return -1 * prod.sum(-1)
+
+def surprisal(logprobs, targets):
+    """Returns the surprisal of the target at each row of a log probability matrix."""
+    return -1 * logprobs.gather(-1, targets.unsqueeze(-1)).squeeze(-1)
+
+def guesses(o, n):
+    """Returns the scores and indices of the n best guesses in each row of o."""
+    return torch.topk(o, n, -1)
+
+def word_metrics(o, t, complexn=0, guessn=0):
+    """Computes the word-level complexity metrics of one sentence.
+
+    o holds the output scores at each position and t the target at each
+    position. Returns a dict of per-position tensors: 'surp' and 'entropy',
+    plus 'guesses' and 'guessscores' when guessn > 0.
+    """
+    logprobs = log_probs(o, complexn)
+    metrics = {'entropy': entropy(logprobs),
+               'surp': surprisal(logprobs, t)}
+    if guessn > 0:
+        metrics['guessscores'], metrics['guesses'] = guesses(o, guessn)
+    return metrics
+
+###############################################################################
+# Lookahead (hallucination) entropy
+#
+# At every position of a sentence the model imagines nhallucinate further
+# steps, each fed the expected embedding under the previous prediction, and
+# sums the entropies of those imagined predictions. Rather than branching
+# off one position at a time, the real prefix is run once while keeping the
+# recurrent state after every position, and then all positions of all
+# sentences roll out together as one large batch.
+###############################################################################
+
+def map_hidden(func, hidden):
+    """Applies func to each tensor of a hidden state (a tensor or an LSTM (h, c) tuple)."""
+    if isinstance(hidden, tuple):
+        return tuple(func(h) for h in hidden)
+    return func(hidden)
+
+@torch.no_grad()
+def step_states(model, data, hidden):
+    """Runs data through the model one position at a time.
+
+    Returns the outputs, shaped like model(data, hidden)[0], and the
+    recurrent state after every position, concatenated position-major
+    along the batch dimension: column t * batch + b of the result holds the
+    state of sentence b after consuming position t.
+    """
+    outputs = []
+    states = []
+    for t in range(data.size(0)):
+        output, hidden = model(data[t:t+1], hidden)
+        outputs.append(output)
+        states.append(hidden)
+    if isinstance(states[0], tuple):
+        states = tuple(torch.cat([s[i] for s in states], 1) for i in range(len(states[0])))
+    else:
+        states = torch.cat(states, 1)
+    return torch.cat(outputs, 0), states
+
+@torch.no_grad()
+def run_prefixes(model, prefixes, device=None):
+    """Runs lists of ids through the model as one padded batch.
+
+    Returns the output scores after the last id of each prefix, one row
+    per prefix, and the recurrent state at that point, one column per
+    prefix.
+    """
+    lengths = [len(p) for p in prefixes]
+    data = torch.zeros(max(lengths), len(prefixes), dtype=torch.long)
+    for col, p in enumerate(prefixes):
+        data[:len(p), col] = torch.LongTensor(p)
+    outputs, states = step_states(model, data.to(device), model.init_hidden(len(prefixes)))
+    # position-major: column t * batch + b holds prefix b after position t
+    last = torch.LongTensor([(n - 1) * len(prefixes) + b for b, n in enumerate(lengths)]).to(device)
+    output = outputs.view(-1, outputs.size(2)).index_select(0, last)
+    return output, map_hidden(lambda h: h.index_select(1, last), states)
+
+@torch.no_grad()
+def rollout_entropies(model, scores, states, nhallucinate, complexn=0, budget=ROLLOUT_BUDGET):
+    """Returns the summed entropy of nhallucinate imagined steps from each position.
+
+    scores holds one row of output scores per position and states the
+    recurrent state after each position, one column per row of scores.
+    Rollouts are run as many positions at a time as keep each score matrix
+    (scores, softmax, log probabilities, ...) within budget bytes, so memory
+    stays bounded with large vocabularies.
+    """
+    chunk = max(1, budget // (scores.size(1) * scores.element_size()))
+    entropies = scores.new(scores.size(0)).zero_()
+    for start in range(0, scores.size(0), chunk):
+        ix = torch.arange(start, min(start + chunk, scores.size(0)), device=scores.device)
+        output = scores.index_select(0, ix).unsqueeze(0)
+        hidden = map_hidden(lambda h: h.index_select(1, ix), states)
+        for hallix in range(nhallucinate):
+            output, hidden = model(nn.functional.softmax(output, dim=2), hidden)
+            entropies[ix] += entropy(log_probs(output.squeeze(0), complexn))
+    return entropies
+
+def valid_positions(seq_len, bsz, lengths=None, device=None):
+    """Returns the position-major indices of the unpadded positions of a batch."""
+    if lengths is None:
+        return torch.arange(seq_len * bsz, device=device)
+    lengths = torch.as_tensor(lengths, device=device)
+    valid = torch.arange(seq_len, device=device).unsqueeze(1) < lengths.unsqueeze(0)
+    return valid.view(-1).nonzero().view(-1)
+
+@torch.no_grad()
+def lookahead(model, data, hidden, nhallucinate, complexn=0, lengths=None, budget=ROLLOUT_BUDGET):
+    """Computes real outputs and lookahead entropies for a batch of sentences.
+
+    data is a (seq_len, batch) tensor of input ids and hidden the initial
+    state of the batch; lengths gives the number of real positions in each
+    column (default: all of them). Returns the real outputs, shaped like
+    model(data, hidden)[0], and a (seq_len, batch) tensor holding, for each
+    position, the summed entropy of nhallucinate imagined future steps.
+    Padded positions get an entropy of 0.
+    """
+    seq_len, bsz = data.size(0), data.size(1)
+    outputs, states = step_states(model, data, hidden)
+    # one rollout per real position, flattened position-major
+    scores = outputs.view(seq_len * bsz, -1)
+    entropies = scores.new(seq_len * bsz).zero_()
+    keep = valid_positions(seq_len, bsz, lengths, data.device)
+    entropies[keep] = rollout_entropies(model, scores.index_select(0, keep),
+                                        map_hidden(lambda h: h.index_select(1, keep), states),
+                                        nhallucinate, complexn, budget)
+    return outputs, entropies.view(seq_len, bsz)
@@ -1,9 +1,391 @@
 import os
+import re
 import torch
-import dill
 import gzip
+import hashlib
+import io
+import json
+import locale
+import mmap
+import multiprocessing
+import tempfile
+import threading
+import time
+import zlib
+import numpy as np
+from array import array
+from collections import deque
+from itertools import islice
+from queue import Queue
 
-from nltk import sent_tokenize
+def open_text(path):
+    """Opens a plain or gzipped text file for streaming line-by-line reads."""
+    if path[-2:] == 'gz':
+        return gzip.open(path, 'rt')
+    return open(path, 'r')
+
+###############################################################################
+# Sentence segmentation
+#
+# A segmenter splits a block of text lines into sentences:
+#   punkt  NLTK's Punkt model, as nltk.sent_tokenize applies it to each line
+#          (the default); the model is loaded once per process
+#   regex  splits after '.', '!' or '?' (and any closing quote or bracket)
+#          followed by whitespace
+#   line   every line is one sentence, for corpora that are segmented already
+# Lines are read and segmented in blocks of SEGMENT_BLOCK lines.
+###############################################################################
+
+SEGMENT_BLOCK = 10000
+
+class LineSegmenter(object):
+    name = 'line'
+
+    def split(self, lines):
+        return lines
+
+class RegexSegmenter(object):
+    name = 'regex'
+    BOUNDARY = re.compile(r'(?:(?<=[.!?])|(?<=[.!?][\'")\]]))\s+')
+
+    def split(self, lines):
+        sentences = []
+        for line in lines:
+            sentences.extend(self.BOUNDARY.split(line))
+        return sentences
+
+class PunktSegmenter(object):
+    name = 'punkt'
+
+    def __init__(self, language='english'):
+        # NLTK is slow to import and only needed once a text file is read
+        try:
+            from nltk.tokenize import PunktTokenizer
+        except ImportError:
+            # NLTK < 3.8.2 ships the model as a pickle
+            import nltk.data
+            self.tokenizer = nltk.data.load('tokenizers/punkt/{}.pickle'.format(language))
+        else:
+            self.tokenizer = PunktTokenizer(language)
+
+    def split(self, lines):
+        tokenize = self.tokenizer.tokenize
+        return [sentence for line in lines for sentence in tokenize(line)]
+
+SEGMENTERS = {'punkt': PunktSegmenter, 'regex': RegexSegmenter, 'line': LineSegmenter}
+loaded_segmenters = {}
+
+def check_segmenter(name):
+    """Raises ValueError unless name is a known segmenter (without loading it)."""
+    if name not in SEGMENTERS:
+        raise ValueError('unknown segmenter {!r} (choose from {})'.format(name, ', '.join(sorted(SEGMENTERS))))
+
+def get_segmenter(name):
+    """Returns the segmenter called name, creating it on first use in this process."""
+    if name not in loaded_segmenters:
+        check_segmenter(name)
+        loaded_segmenters[name] = SEGMENTERS[name]()
+    return loaded_segmenters[name]
+
+def iter_sentences(lines, segmenter='punkt'):
+    """Yields the non-blank sentences found in an iterable of text lines."""
+    segmenter = get_segmenter(segmenter)
+    lines = iter(lines)
+    while True:
+        block = list(islice(lines, SEGMENT_BLOCK))
+        if not block:
+            return
+        for line in segmenter.split(block):
+            if line.strip() == '':
+                #ignore blank lines
+                continue
+            yield line
+
+###############################################################################
+# Parallel tokenization
+#
+# Worker processes tokenize shards of a file against a shard-local
+# vocabulary and return (local idx2word, local ids). The parent maps each
+# shard's local vocabulary into the global Dictionary in shard order, so
+# words are added in exactly the order of their first occurrence in the
+# file, just as the serial tokenizer would add them. When the segmentation
+# is being cached, workers also return the sentences of their shard, which
+# the parent writes to the cached copy in shard order.
+###############################################################################
+
+SHARD_BYTES = 1 << 26
+
+def shard_text_file(path, nshards):
+    """Splits a plain text file into byte ranges that start on line boundaries."""
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, nshards):
+            f.seek(max(size * i // nshards, bounds[-1]))
+            f.readline()
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+    return [(path, start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+def iter_line_blocks(path, block_lines=100000):
+    """Yields successive blocks of lines from a (possibly gzipped) text file."""
+    with open_text(path) as f:
+        while True:
+            block = list(islice(f, block_lines))
+            if not block:
+                return
+            yield block
+
+def bounded_imap(pool, func, items, window):
+    """Like pool.imap, but keeps at most window tasks in flight."""
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def tokenize_block(block):
+    """Tokenizes a (lines, segmenter, keep_text) block against a fresh, shard-local vocabulary.
+
+    With keep_text, also returns the sentences found, one per line, as
+    TokenCache.segmented writes them; otherwise None.
+    """
+    lines, segmenter, keep_text = block
+    vocab = Dictionary()
+    ids = array('q')
+    offsets = array('q')
+    text = [] if keep_text else None
+    for line in iter_sentences(lines, segmenter):
+        offsets.append(len(ids))
+        ids.extend([vocab.add_word(word) for word in line.split() + ['<eos>']])
+        if keep_text:
+            text.append(line.strip() + '\n')
+    return vocab.idx2word, ids, offsets, text if text is None else ''.join(text)
+
+class ByteRange(io.RawIOBase):
+    ## a read-only raw stream over bytes [start, end) of an open binary file
+    def __init__(self, f, start, end):
+        self.f = f
+        self.f.seek(start)
+        self.remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        n = self.f.readinto(memoryview(buf)[:min(len(buf), self.remaining)])
+        self.remaining -= n
+        return n
+
+def tokenize_byte_range(shard):
+    """Tokenizes the lines of a plain text file starting within [start, end)."""
+    path, start, end, segmenter, keep_text = shard
+    # decoded like open_text, i.e. with universal newlines: a bare '\r'
+    # ends a line too. Shards start after a b'\n', which always ends a line.
+    with open(path, 'rb') as f:
+        lines = io.TextIOWrapper(io.BufferedReader(ByteRange(f, start, end)),
+                                 encoding=locale.getpreferredencoding(False))
+        return tokenize_block((lines, segmenter, keep_text))
+
+###############################################################################
+# Token cache helpers
+###############################################################################
+
+def file_hash(path, blocksize=1 << 24):
+    """Returns a content hash of a file, read in large blocks."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def vocab_hash(dictionary):
+    """Returns a hash of a Dictionary's words in index order."""
+    h = hashlib.blake2b(digest_size=16)
+    words = dictionary.idx2word
+    if isinstance(dictionary, CompactDictionary):
+        # the mapped blob already holds the newline-terminated words
+        h.update(dictionary.blob())
+        words = dictionary.extra
+    for word in words:
+        h.update(word.encode('utf-8'))
+        h.update(b'\n')
+    return h.hexdigest()
+
+def load_npy(path):
+    """Memory-maps a .npy file copy-on-write, so tensors built on it are writable views."""
+    return np.load(path, mmap_mode='c')
+
+###############################################################################
+# Compact vocabulary files
+#
+# lm_data files are written in a flat, memory-mappable layout (little-endian):
+#   8-byte magic
+#   int64 header: number of words, blob size, hash table size
+#   int64 offsets[nwords + 1] of each word in the blob
+#   int32 hash table: crc32(word) -> word index, linear probing, -1 = empty
+#   blob of newline-terminated UTF-8 words in index order
+# Loading maps the file instead of unpickling one string and dict entry per
+# word. Dictionaries pickled with dill (and the older tuple format) still
+# load.
+###############################################################################
+
+VOCAB_MAGIC = b'LMVOCAB\x01'
+
+def write_vocab(path, words):
+    """Writes words, in index order, to a compact vocabulary file."""
+    encoded = [word.encode('utf-8') + b'\n' for word in words]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(word) for word in encoded])
+    ntable = 8
+    while ntable < 2 * len(encoded):
+        ntable *= 2
+    mask = ntable - 1
+    table = [-1] * ntable
+    for idx, word in enumerate(encoded):
+        slot = zlib.crc32(word[:-1]) & mask
+        while table[slot] >= 0:
+            slot = (slot + 1) & mask
+        table[slot] = idx
+    with open(path, 'wb') as f:
+        f.write(VOCAB_MAGIC)
+        f.write(np.array([len(encoded), offsets[-1], ntable], dtype='<i8').tobytes())
+        f.write(offsets.astype('<i8').tobytes())
+        f.write(np.array(table, dtype='<i4').tobytes())
+        f.write(b''.join(encoded))
+
+class CompactDictionary(object):
+    """A Dictionary backed by a memory-mapped compact vocabulary file.
+
+    idx2word and word2idx behave like the list and dict of a Dictionary:
+    words are decoded from the mapped blob on first use and memoized, and
+    word lookups probe the on-disk hash table. Words added after loading
+    (e.g. <unk> while tokenizing a test set) are kept in memory.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        start = len(VOCAB_MAGIC)
+        nwords, nblob, ntable = [int(n) for n in np.frombuffer(self.mm, '<i8', 3, start)]
+        start += 24
+        self.offsets = np.frombuffer(self.mm, '<i8', nwords + 1, start)
+        start += 8 * (nwords + 1)
+        self.table = np.frombuffer(self.mm, '<i4', ntable, start)
+        self.blob_start = start + 4 * ntable
+        self.nwords = nwords
+        self.extra = []
+        self.words = {}
+        self.ids = {}
+        self.idx2word = CompactWords(self)
+        self.word2idx = CompactIndex(self)
+
+    def blob(self):
+        return self.mm[self.blob_start:self.blob_start + int(self.offsets[-1])]
+
+    def word(self, idx):
+        ## returns word idx (an int in [0, len(self)))
+        word = self.words.get(idx)
+        if word is None:
+            if idx >= self.nwords:
+                return self.extra[idx - self.nwords]
+            start = self.blob_start + int(self.offsets[idx])
+            word = self.mm[start:self.blob_start + int(self.offsets[idx + 1]) - 1].decode('utf-8')
+            self.words[idx] = word
+        return word
+
+    def find(self, word):
+        ## returns the index of word, or -1 if it is not in the vocabulary
+        idx = self.ids.get(word)
+        if idx is not None:
+            return idx
+        encoded = word.encode('utf-8')
+        mask = len(self.table) - 1
+        slot = zlib.crc32(encoded) & mask
+        while True:
+            idx = int(self.table[slot])
+            if idx < 0:
+                return -1
+            start = self.blob_start + int(self.offsets[idx])
+            if self.mm[start:self.blob_start + int(self.offsets[idx + 1]) - 1] == encoded:
+                self.ids[word] = idx
+                return idx
+            slot = (slot + 1) & mask
+
+    def add_word(self, word):
+        idx = self.find(word)
+        if idx < 0:
+            self.extra.append(word)
+            idx = len(self) - 1
+            self.ids[word] = idx
+        return idx
+
+    def __len__(self):
+        return self.nwords + len(self.extra)
+
+class CompactWords(object):
+    """The idx2word list of a CompactDictionary."""
+    def __init__(self, dictionary):
+        self.dictionary = dictionary
+
+    def __len__(self):
+        return len(self.dictionary)
+
+    def __getitem__(self, idx):
+        idx = int(idx)
+        if idx < 0:
+            idx += len(self.dictionary)
+        if not 0 <= idx < len(self.dictionary):
+            raise IndexError('word index out of range')
+        return self.dictionary.word(idx)
+
+    def __iter__(self):
+        for idx in range(len(self.dictionary)):
+            yield self.dictionary.word(idx)
+
+    def index(self, word):
+        idx = self.dictionary.find(word)
+        if idx < 0:
+            raise ValueError('{!r} is not in the vocabulary'.format(word))
+        return idx
+
+class CompactIndex(object):
+    """The word2idx dict of a CompactDictionary."""
+    def __init__(self, dictionary):
+        self.dictionary = dictionary
+
+    def __len__(self):
+        return len(self.dictionary)
+
+    def __contains__(self, word):
+        return self.dictionary.find(word) >= 0
+
+    def __getitem__(self, word):
+        idx = self.dictionary.find(word)
+        if idx < 0:
+            raise KeyError(word)
+        return idx
+
+    def get(self, word, default=None):
+        idx = self.dictionary.find(word)
+        return default if idx < 0 else idx
+
+def load_dictionary(path):
+    """Loads the Dictionary saved in an lm_data file."""
+    assert os.path.exists(path)
+    with open(path, 'rb') as f:
+        compact = f.read(len(VOCAB_MAGIC)) == VOCAB_MAGIC
+    if compact:
+        return CompactDictionary(path)
+    # a Dictionary pickled by an older version
+    import dill
+    with open(path, 'rb') as f:
+        fdata = torch.load(f, pickle_module=dill)
+        if type(fdata) == type(()):
+            # compatibility with old pytorch LM saving
+            return(fdata[3])
+        return(fdata)
 
 class convertvocab(object):
     def __init__(self, load_from, save_to):
@@ -12,8 +394,7 @@ class convertvocab(object):
         self.save_to = self.save_dict(save_to)
 
     def save_dict(self, path):
-        with open(path, 'wb') as f:
-            torch.save(self.dictionary, f, pickle_module=dill)
+        write_vocab(path, self.dictionary.idx2word)
 
     def load_dict(self, path):
         assert os.path.exists(path)
@@ -35,238 +416,397 @@ class Dictionary(object):
     def __len__(self):
         return len(self.idx2word)
 
+class SentenceIndex(object):
+    """A sentence-segmented corpus stored as one flat id tensor plus offsets.
+
+    Sentence i is the zero-copy view ids[offsets[i]:offsets[i+1]]. The raw
+    sentence strings live in a newline-separated text file and are read on
+    demand through byte offsets instead of being kept in memory.
+    """
+    def __init__(self, ids, offsets, text, text_offsets=None):
+        self.ids = ids
+        self.offsets = offsets
+        if isinstance(text, str):
+            text = open(text, 'rb')
+        self.text = text
+        if text_offsets is None:
+            # one sentence per line, so sentence starts follow each newline
+            newlines = np.zeros(0, dtype=np.int64)
+            if os.path.getsize(text.name) > 0:
+                newlines = np.flatnonzero(np.memmap(text.name, dtype=np.uint8, mode='r') == ord('\n'))
+            text_offsets = np.concatenate([[0], newlines + 1])
+        self.text_offsets = text_offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.ids[int(self.offsets[i]):int(self.offsets[i+1])]
+
+    def lengths(self):
+        """Returns the number of ids in each sentence."""
+        return np.diff(self.offsets)
+
+    def sentence(self, i):
+        """Reads the raw text of sentence i."""
+        start = int(self.text_offsets[i])
+        self.text.seek(start)
+        return self.text.read(int(self.text_offsets[i+1]) - start - 1).decode('utf-8')
+
+class TokenCache(object):
+    """On-disk cache of tokenized corpora.
+
+    Each entry holds a flat int32 id array and an int64 array of sentence
+    start offsets (with a final end offset), both stored as .npy files and
+    memory-mapped on load. Entries are named by a content hash of the source
+    file and of the vocabulary used to tokenize it, by the sentence
+    segmenter, and by the layout of the ids: 'stream' (train/valid, only
+    the first sentence opens with <eos>) or 'sents' (test sets, every
+    sentence is <eos> ... <eos>, with a .sents text sidecar). A changed
+    corpus, lm_data file, segmenter or layout simply misses the cache.
+    The segmentation of each file is also cached on its own, as a text
+    file with one sentence per line, so tokenizing the same corpus against
+    another vocabulary does not segment it again.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, path, dictionary, segmenter, layout):
+        return '.'.join([os.path.basename(path), file_hash(path), vocab_hash(dictionary), segmenter, layout])
+
+    def segmented_path(self, path, segmenter):
+        """Returns where the copy of path with one sentence per line is cached (it may not exist yet)."""
+        return self.entry('.'.join([os.path.basename(path), file_hash(path), segmenter]), '.sents.txt')
+
+    def segmented(self, path, segmenter):
+        """Returns the path of a cached copy of path with one sentence per line, writing it on a miss."""
+        cached = self.segmented_path(path, segmenter)
+        if not os.path.exists(cached):
+            tmp = cached + '.tmp' + str(os.getpid())
+            with open_text(path) as f, open(tmp, 'w') as out:
+                for line in iter_sentences(f, segmenter):
+                    out.write(line.strip() + '\n')
+            os.replace(tmp, cached)
+        return cached
+
+    def entry(self, key, suffix):
+        return os.path.join(self.cache_dir, key + suffix)
+
+    def load(self, key):
+        """Returns (ids, offsets, meta) for a cached entry, or None on a miss."""
+        if not os.path.exists(self.entry(key, '.json')):
+            return None
+        with open(self.entry(key, '.json'), 'r') as f:
+            meta = json.load(f)
+        ids = load_npy(self.entry(key, '.ids.npy'))
+        offsets = load_npy(self.entry(key, '.idx.npy'))
+        return torch.from_numpy(ids), offsets, meta
+
+    def save(self, key, ids, offsets, meta):
+        """Writes a cache entry; the metadata file is written last to mark it complete."""
+        tmp = self.entry(key, '.ids.tmp.npy')
+        mm = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.int32, shape=(len(ids),))
+        mm[:] = ids.numpy()
+        mm.flush()
+        del mm
+        os.replace(tmp, self.entry(key, '.ids.npy'))
+        tmp = self.entry(key, '.idx.tmp.npy')
+        np.save(tmp, np.asarray(offsets, dtype=np.int64))
+        os.replace(tmp, self.entry(key, '.idx.npy'))
+        tmp = self.entry(key, '.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, self.entry(key, '.json'))
+
 class SentenceCorpus(object):
     def __init__(self, path, save_to, testflag=False,
                  trainfname='train.txt',
                  validfname='valid.txt',
-                 testfname='test.txt'):
+                 testfname='test.txt',
+                 workers=1,
+                 cache_dir=None,
+                 segmenter='punkt'):
+        self.workers = workers
+        self.cache = TokenCache(cache_dir) if cache_dir else None
+        # fail on an unknown name before any file is read; the segmenter
+        # itself (and NLTK for punkt) is only loaded if text is segmented
+        check_segmenter(segmenter)
+        self.segmenter = segmenter
         if not testflag:
-            self.dictionary = Dictionary()
-            self.train = self.tokenize(os.path.join(path, trainfname))
-            self.valid = self.tokenize_with_unks(os.path.join(path, validfname))
-            self.save_to = self.save_dict(save_to)
+            trainpath = os.path.join(path, trainfname)
+            validpath = os.path.join(path, validfname)
+            if not self.load_cached(save_to, trainpath, validpath):
+                self.dictionary = Dictionary()
+                self.train, train_offsets = self.encode_file(trainpath, self.dictionary.add_word)
+                self.valid, valid_offsets = self.encode_file(validpath, self.lookup_with_unk)
+                self.save_to = self.save_dict(save_to)
+                if self.cache is not None:
+                    # keyed by the final vocabulary, i.e. the one saved to lm_data
+                    meta = {'ntokens': len(self.dictionary)}
+                    self.cache.save(self.cache.key(trainpath, self.dictionary, self.segmenter, 'stream'), self.train, train_offsets, meta)
+                    self.cache.save(self.cache.key(validpath, self.dictionary, self.segmenter, 'stream'), self.valid, valid_offsets, meta)
         else:
             self.dictionary = self.load_dict(save_to)
             self.test = self.sent_tokenize_with_unks(os.path.join(path, testfname))
 
+    def load_cached(self, save_to, trainpath, validpath):
+        """Restores train/valid ids and the dictionary from the token cache, if possible."""
+        if self.cache is None or not os.path.exists(save_to):
+            return False
+        dictionary = self.load_dict(save_to)
+        train = self.cache.load(self.cache.key(trainpath, dictionary, self.segmenter, 'stream'))
+        valid = self.cache.load(self.cache.key(validpath, dictionary, self.segmenter, 'stream'))
+        if train is None or valid is None:
+            return False
+        self.dictionary = dictionary
+        self.train = train[0]
+        self.valid = valid[0]
+        self.save_to = None
+        return True
+
     def save_dict(self, path):
-        with open(path, 'wb') as f:
-            torch.save(self.dictionary, f, pickle_module=dill)
+        # written to a private temporary file and renamed into place, so
+        # concurrent training processes never see a partial vocabulary
+        tmp = path + '.tmp' + str(os.getpid())
+        write_vocab(tmp, self.dictionary.idx2word)
+        os.replace(tmp, path)
 
     def load_dict(self, path):
+        return load_dictionary(path)
+
+    def segmented(self, path):
+        ## returns (path, segmenter) to read the sentences of path with
+        ## With a cache, the file is segmented once into a cached copy with
+        ## one sentence per line, which is then read line by line.
+        if self.cache is None or self.segmenter == 'line':
+            return path, self.segmenter
+        return self.cache.segmented(path, self.segmenter), 'line'
+
+    def iter_sentences(self, path):
+        """Yields the non-blank sentences of a text file, streaming line by line."""
+        path, segmenter = self.segmented(path)
+        with open_text(path) as f:
+            for line in iter_sentences(f, segmenter):
+                yield line
+
+    def lookup_with_unk(self, word):
+        """Returns the index of word, mapping unknown words to <unk>."""
+        if word not in self.dictionary.word2idx:
+            return self.dictionary.add_word("<unk>")
+        return self.dictionary.word2idx[word]
+
+    def encode(self, path, lookup):
+        """Maps a text file to a flat id tensor in a single streaming pass.
+
+        Ids are appended to a compact int64 buffer one sentence at a time
+        and converted to a tensor once at the end, so the file is never
+        held in memory as text and never read twice. Also returns the
+        offset at which each sentence starts, followed by the total length.
+        """
+        ids = array('q')
+        offsets = array('q')
+        FIRST = True
+        for line in self.iter_sentences(path):
+            offsets.append(len(ids))
+            if FIRST:
+                words = ['<eos>'] + line.split() + ['<eos>']
+                FIRST = False
+            else:
+                words = line.split() + ['<eos>']
+            ids.extend([lookup(word) for word in words])
+        offsets.append(len(ids))
+        return torch.from_numpy(np.frombuffer(ids, dtype=np.int64)), np.frombuffer(offsets, dtype=np.int64)
+
+    def parallel_encode(self, path, lookup):
+        """Maps a text file to a flat id tensor using a pool of worker processes.
+
+        Plain text is split into byte-range shards that each worker reads
+        itself; gzipped text is decompressed here and handed out in blocks
+        of lines. Shard results are merged in file order, which yields the
+        same ids, offsets and Dictionary ordering as encode(). On a miss of
+        the segmentation cache, the workers segment their shards and the
+        parent assembles the cached copy from them.
+        """
+        segmenter = self.segmenter
+        textfile = None
+        if self.cache is not None and segmenter != 'line':
+            cached = self.cache.segmented_path(path, segmenter)
+            if os.path.exists(cached):
+                path, segmenter = cached, 'line'
+            else:
+                textpath = cached + '.tmp' + str(os.getpid())
+                textfile = open(textpath, 'w')
+        keep_text = textfile is not None
+        if path[-2:] == 'gz':
+            shards = ((lines, segmenter, keep_text) for lines in iter_line_blocks(path))
+            work = tokenize_block
+        else:
+            # several shards per worker evens out uneven sentence densities
+            nshards = max(4 * self.workers, os.path.getsize(path) // SHARD_BYTES)
+            shards = [shard + (segmenter, keep_text) for shard in shard_text_file(path, nshards)]
+            work = tokenize_byte_range
+        chunks = []
+        starts = []
+        ntokens = 0
+        with multiprocessing.Pool(self.workers) as pool:
+            for local_words, local_ids, local_offsets, text in bounded_imap(pool, work, shards, 2 * self.workers):
+                if keep_text:
+                    textfile.write(text)
+                if len(local_ids) == 0:
+                    continue
+                if ntokens == 0:
+                    # the serial tokenizer opens the corpus with an <eos>
+                    chunks.append(np.array([lookup('<eos>')], dtype=np.int64))
+                    starts.append(np.zeros(1, dtype=np.int64))
+                    ntokens = 1
+                    local_offsets = local_offsets[1:]
+                local2global = np.array([lookup(word) for word in local_words], dtype=np.int64)
+                chunks.append(local2global[np.frombuffer(local_ids, dtype=np.int64)])
+                starts.append(np.frombuffer(local_offsets, dtype=np.int64) + ntokens)
+                ntokens += len(local_ids)
+        if keep_text:
+            textfile.close()
+            os.replace(textpath, cached)
+        starts.append(np.array([ntokens], dtype=np.int64))
+        if not chunks:
+            return torch.LongTensor(0), starts[-1]
+        return torch.from_numpy(np.concatenate(chunks)), np.concatenate(starts)
+
+    def encode_file(self, path, lookup):
+        """Returns (ids, sentence offsets) for a text file."""
         assert os.path.exists(path)
-        with open(path, 'rb') as f:
-            fdata = torch.load(f, pickle_module=dill)
-            if type(fdata) == type(()):
-                # compatibility with old pytorch LM saving
-                return(fdata[3])
-            return(fdata)
+        if self.workers > 1:
+            return self.parallel_encode(path, lookup)
+        return self.encode(path, lookup)
 
     def tokenize(self, path):
         """Tokenizes a text file."""
-        assert os.path.exists(path)
-        # Add words to the dictionary
-        if path[-2:] == 'gz':
-            with gzip.open(path, 'rb') as f:
-                tokens = 0
-                FIRST = True
-                for fchunk in f.readlines():
-                    for line in sent_tokenize(fchunk):
-                        if line.strip() == '':
-                            #ignore blank lines
-                            continue
-                        if FIRST:
-                            words = ['<eos>'] + line.split() + ['<eos>']
-                            FIRST = False
-                        else:
-                            words = line.split() + ['<eos>']
-                        tokens += len(words)
-                        for word in words:
-                            self.dictionary.add_word(word)
-
-            # Tokenize file content
-            with gzip.open(path, 'rb') as f:
-                ids = torch.LongTensor(tokens)
-                token = 0
-                FIRST = True
-                for fchunk in f.readlines():
-                    for line in sent_tokenize(fchunk):
-                        if line.strip() == '':
-                            #ignore blank lines
-                            continue
-                        if FIRST:
-                            words = ['<eos>'] + line.split() + ['<eos>']
-                            FIRST = False
-                        else:
-                            words = line.split() + ['<eos>']
-                        for word in words:
-                            ids[token] = self.dictionary.word2idx[word]
-                            token += 1
-        else:
-            with open(path, 'r') as f:
-                tokens = 0
-                FIRST = True
-                for fchunk in f:
-                    #print fchunk
-                    for line in sent_tokenize(fchunk):
-                        if line.strip() == '':
-                            #ignore blank lines
-                            continue
-                        if FIRST:
-                            words = ['<eos>'] + line.split() + ['<eos>']
-                            FIRST = False
-                        else:
-                            words = line.split() + ['<eos>']
-                        tokens += len(words)
-                        for word in words:
-                            self.dictionary.add_word(word)
-
-            # Tokenize file content
-            with open(path, 'r') as f:
-                ids = torch.LongTensor(tokens)
-                token = 0
-                FIRST = True
-                for fchunk in f:
-                    for line in sent_tokenize(fchunk):
-                        if line.strip() == '':
-                            #ignore blank lines
-                            continue
-                        if FIRST:
-                            words = ['<eos>'] + line.split() + ['<eos>']
-                            FIRST = False
-                        else:
-                            words = line.split() + ['<eos>']
-                        for word in words:
-                            ids[token] = self.dictionary.word2idx[word]
-                            token += 1
-        return ids
+        # Add words to the dictionary while tokenizing file content
+        return self.encode_file(path, self.dictionary.add_word)[0]
 
     def tokenize_with_unks(self, path):
         """Tokenizes a text file, adding unks if needed."""
-        assert os.path.exists(path)
-        if path[-2:] == 'gz':
-            # Add words to the dictionary
-            with gzip.open(path, 'rb') as f:
-                tokens = 0
-                FIRST = True
-                for fchunk in f.readlines():
-                    for line in sent_tokenize(fchunk):
-                        if line.strip() == '':
-                            #ignore blank lines
-                            continue
-                        if FIRST:
-                            words = ['<eos>'] + line.split() + ['<eos>']
-                            FIRST = False
-                        else:
-                            words = line.split() + ['<eos>']
-                        tokens += len(words)
-
-            # Tokenize file content
-            with gzip.open(path, 'rb') as f:
-                ids = torch.LongTensor(tokens)
-                token = 0
-                FIRST = True
-                for fchunk in f.readlines():
-                    for line in sent_tokenize(fchunk):
-                        if line.strip() == '':
-                            #ignore blank lines
-                            continue
-                        if FIRST:
-                            words = ['<eos>'] + line.split() + ['<eos>']
-                            FIRST = False
-                        else:
-                            words = line.split() + ['<eos>']
-                        for word in words:
-                            if word not in self.dictionary.word2idx:
-                                ids[token] = self.dictionary.add_word("<unk>")
-                            else:
-                                ids[token] = self.dictionary.word2idx[word]
-                            token += 1
-        else:
-            # Add words to the dictionary
-            with open(path, 'r') as f:
-                tokens = 0
-                FIRST = True
-                for fchunk in f:
-                    for line in sent_tokenize(fchunk):
-                        if line.strip() == '':
-                            #ignore blank lines
-                            continue
-                        if FIRST:
-                            words = ['<eos>'] + line.split() + ['<eos>']
-                            FIRST = False
-                        else:
-                            words = line.split() + ['<eos>']
-                        tokens += len(words)
-
-            # Tokenize file content
-            with open(path, 'r') as f:
-                ids = torch.LongTensor(tokens)
-                token = 0
-                FIRST = True
-                for fchunk in f:
-                    for line in sent_tokenize(fchunk):
-                        if line.strip() == '':
-                            #ignore blank lines
-                            continue
-                        if FIRST:
-                            words = ['<eos>'] + line.split() + ['<eos>']
-                            FIRST = False
-                        else:
-                            words = line.split() + ['<eos>']
-                        for word in words:
-                            if word not in self.dictionary.word2idx:
-                                ids[token] = self.dictionary.add_word("<unk>")
-                            else:
-                                ids[token] = self.dictionary.word2idx[word]
-                            token += 1
-        return ids
+        return self.encode_file(path, self.lookup_with_unk)[0]
 
     def sent_tokenize_with_unks(self, path):
         """Tokenizes a text file into sentences, adding unks if needed."""
         assert os.path.exists(path)
-        all_ids = []
-        sents = []
-        if path [-2:] == 'gz':
-            with gzip.open(path, 'rb') as f:
-                for fchunk in f.readlines():
-                    for line in sent_tokenize(fchunk):
-                        if line.strip() == '':
-                            #ignore blank lines
-                            continue
-                        sents.append(line.strip())
-                        words = ['<eos>'] + line.split() + ['<eos>']
-                        tokens = len(words)
-
-                        # tokenize file content
-                        ids = torch.LongTensor(tokens)
-                        token = 0
-                        for word in words:
-                            if word not in self.dictionary.word2idx:
-                                ids[token] = self.dictionary.add_word("<unk>")
-                            else:
-                                ids[token] = self.dictionary.word2idx[word]
-                            token += 1
-                        all_ids.append(ids)
+        if self.cache is not None:
+            key = self.cache.key(path, self.dictionary, self.segmenter, 'sents')
+            cached = self.cache.load(key)
+            if cached is not None:
+                ids, offsets, meta = cached
+                if meta['ntokens'] > len(self.dictionary):
+                    # tokenizing the test set introduced <unk>
+                    self.dictionary.add_word("<unk>")
+                return SentenceIndex(ids, offsets, self.cache.entry(key, '.sents'))
+            textpath = self.cache.entry(key, '.sents.tmp')
+            textfile = open(textpath, 'wb')
         else:
-            with open(path, 'r') as f:
-                for fchunk in f:
-                    for line in sent_tokenize(fchunk):
-                        if line.strip() == '':
-                            #ignore blank lines
-                            continue
-                        sents.append(line.strip())
-                        words = ['<eos>'] + line.split() + ['<eos>']
-                        tokens = len(words)
-
-                        # tokenize file content
-                        ids = torch.LongTensor(tokens)
-                        token = 0
-                        for word in words:
-                            if word not in self.dictionary.word2idx:
-                                ids[token] = self.dictionary.add_word("<unk>")
-                            else:
-                                ids[token] = self.dictionary.word2idx[word]
-                            token += 1
-                        all_ids.append(ids)
-        return (sents, all_ids)
+            textfile = tempfile.TemporaryFile()
+        ids = array('q')
+        offsets = array('q')
+        text_offsets = array('q')
+        for line in self.iter_sentences(path):
+            text_offsets.append(textfile.tell())
+            textfile.write((line.strip() + '\n').encode('utf-8'))
+            offsets.append(len(ids))
+            words = ['<eos>'] + line.split() + ['<eos>']
+            # tokenize file content
+            ids.extend([self.lookup_with_unk(word) for word in words])
+        offsets.append(len(ids))
+        text_offsets.append(textfile.tell())
+        ids = torch.from_numpy(np.frombuffer(ids, dtype=np.int64))
+        offsets = np.frombuffer(offsets, dtype=np.int64)
+        text_offsets = np.frombuffer(text_offsets, dtype=np.int64)
+        if self.cache is None:
+            return SentenceIndex(ids, offsets, textfile, text_offsets)
+        textfile.close()
+        os.replace(textpath, self.cache.entry(key, '.sents'))
+        self.cache.save(key, ids, offsets, {'ntokens': len(self.dictionary)})
+        return SentenceIndex(ids, offsets, self.cache.entry(key, '.sents'), text_offsets)
+
+class BPTTIterator(object):
+    """Iterates over the (data, target) bptt chunks of a batchified source.
+
+    A background thread slices the upcoming chunks and, when device is a
+    GPU, pins them and starts non-blocking host to device copies, so the
+    next chunk is ready while the current one computes. With variable=True
+    chunk lengths are drawn around bptt as in Merity et al. (2017): usually
+    bptt, sometimes bptt / 2, jittered with a standard deviation of 5 and
+    never below 5. Lengths are drawn up front from their own generator, so
+    they do not depend on thread timing or disturb the torch RNG. The thread
+    adds its slicing and copying time to the slice and copy phases of
+    telemetry, if given. Closing an iteration early (e.g. breaking out of
+    the loop) stops its thread.
+    """
+    def __init__(self, source, bptt, device=None, variable=False, prefetch=2, seed=None, start=0,
+                 telemetry=None):
+        self.source = source
+        self.device = device
+        self.telemetry = telemetry
+        self.prefetch = prefetch
+        # index of the first chunk to yield, e.g. when resuming mid-epoch
+        self.start = start
+        self.chunks = []
+        rng = np.random.RandomState(seed)
+        i = 0
+        while i < source.size(0) - 1:
+            seq_len = bptt
+            if variable:
+                base = bptt if rng.random_sample() < 0.95 else bptt / 2.
+                seq_len = max(5, int(rng.normal(base, 5)))
+            seq_len = min(seq_len, source.size(0) - 1 - i)
+            self.chunks.append((i, seq_len))
+            i += seq_len
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def get_batch(self, i, seq_len):
+        start = time.perf_counter()
+        # cached corpora are memory-mapped as int32
+        data = self.source[i:i+seq_len].long()
+        target = self.source[i+1:i+1+seq_len].long().view(-1)
+        if self.telemetry is not None:
+            self.telemetry.add('slice', time.perf_counter() - start)
+        if self.device is not None and self.device.type == 'cuda':
+            start = time.perf_counter()
+            data = data.pin_memory().to(self.device, non_blocking=True)
+            target = target.pin_memory().to(self.device, non_blocking=True)
+            if self.telemetry is not None:
+                self.telemetry.add('copy', time.perf_counter() - start)
+        return data, target
+
+    def __iter__(self):
+        queue = Queue(self.prefetch)
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for i, seq_len in self.chunks[self.start:]:
+                    if stop.is_set():
+                        return
+                    queue.put(self.get_batch(i, seq_len))
+                queue.put(None)
+            except Exception as e:
+                queue.put(e)
+
+        thread = threading.Thread(target=produce)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                item = queue.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # when the loop stops early, unblock the thread so it can exit
+            stop.set()
+            while not queue.empty():
+                queue.get_nowait()
@@ -7,18 +7,15 @@
 
 import argparse
 
-import torch
-from torch.autograd import Variable
-
-import data
-
 parser = argparse.ArgumentParser(description='PyTorch PTB Language Model')
 
 # Model parameters.
 parser.add_argument('--data', type=str, default='./data/penn',
-                    help='location of the data corpus')
+                    help='location of the data corpus (unused; only the vocabulary is loaded)')
 parser.add_argument('--checkpoint', type=str, default='./model.pt',
                     help='model checkpoint to use')
+parser.add_argument('--quantized', action='store_true',
+                    help='the checkpoint is an int8 TorchScript artifact written by quantize.py')
 parser.add_argument('--outf', type=str, default='generated.txt',
                     help='output file for generated text')
 parser.add_argument('--words', type=int, default='1000',
@@ -29,14 +26,37 @@ parser.add_argument('--cuda', action='store_true',
                     help='use CUDA')
 parser.add_argument('--temperature', type=float, default=1.0,
                     help='temperature - higher will increase diversity')
+parser.add_argument('--streams', type=int, default=1,
+                    help='number of independent samples generated in parallel (one output line each when > 1)')
+parser.add_argument('--prompts', type=str, default=None,
+                    help='file of prompts, one per line, cycled over the streams (default: start from a random word)')
+parser.add_argument('--topk', type=int, default=0,
+                    help='sample only from the k most likely words (0 = all words)')
+parser.add_argument('--topp', type=float, default=1.0,
+                    help='sample only from the most likely words whose probabilities sum to p (nucleus sampling)')
 parser.add_argument('--log-interval', type=int, default=100,
                     help='reporting interval')
 parser.add_argument('--lm_data', type=str, default='lm_data.bin',
                     help='path to save the LM data')
 parser.add_argument('--testfname', type=str, default='test.txt',
-                    help='name of the test file')
+                    help='name of the test file (unused; only the vocabulary is loaded)')
 args = parser.parse_args()
 
+if args.temperature < 1e-3:
+    parser.error("--temperature has to be greater or equal 1e-3")
+if not 0 < args.topp <= 1:
+    parser.error("--topp has to be in (0, 1]")
+if args.quantized and args.cuda:
+    parser.error("--quantized models only run on the CPU")
+
+# torch takes seconds to import, so --help and argument errors return first
+import torch
+
+import data
+import checkpoint
+import quantize
+import complexity
+
 # Set the random seed manually for reproducibility.
 torch.manual_seed(args.seed)
 if torch.cuda.is_available():
@@ -45,36 +65,75 @@ if torch.cuda.is_available():
     else:
         torch.cuda.manual_seed(args.seed)
 
-if args.temperature < 1e-3:
-    parser.error("--temperature has to be greater or equal 1e-3")
-
-with open(args.checkpoint, 'rb') as f:
-    model = torch.load(f)
+if args.quantized:
+    model = quantize.load(args.checkpoint)
+else:
+    model, saved_state = checkpoint.load(args.checkpoint)
+    if args.cuda:
+        model.cuda()
+    else:
+        model.cpu()
 model.eval()
 
-if args.cuda:
-    model.cuda()
-else:
-    model.cpu()
+# sampling only needs the vocabulary, not a tokenized corpus
+dictionary = data.load_dictionary(args.lm_data)
 
-corpus = data.SentenceCorpus(args.data, args.lm_data, True,
-                             testfname=args.testfname)
+ntokens = len(dictionary)
+device = torch.device('cuda' if args.cuda else 'cpu')
 
-ntokens = len(corpus.dictionary)
-hidden = model.init_hidden(1)
-input = Variable(torch.rand(1, 1).mul(ntokens).long(), volatile=True)
-if args.cuda:
-    input.data = input.data.cuda()
+def lookup_with_unk(word):
+    ## returns the id of word, reading words outside the vocabulary as <unk>
+    if word not in dictionary.word2idx:
+        return dictionary.add_word("<unk>")
+    return dictionary.word2idx[word]
 
-with open(args.outf, 'w') as outf:
-    for i in range(args.words):
-        output, hidden = model(input, hidden)
-        word_weights = output.squeeze().data.div(args.temperature).exp().cpu()
-        word_idx = torch.multinomial(word_weights, 1)[0]
-        input.data.fill_(word_idx)
-        word = corpus.dictionary.idx2word[word_idx]
+def read_prompts(path):
+    ## returns the ids of each stream's prompt, preceded by <eos> like a test sentence
+    with open(path, 'r') as f:
+        prompts = [line.split() for line in f if line.strip()]
+    return [[lookup_with_unk(word) for word in ['<eos>'] + prompts[i % len(prompts)]]
+            for i in range(args.streams)]
 
-        outf.write(word + ('\n' if i % 20 == 19 else ' '))
+def sample(scores):
+    ## draws one word per row of scores after temperature, top-k and nucleus filtering
+    scores = scores.div(args.temperature)
+    ix = None
+    if args.topk > 0 or args.topp < 1:
+        # only the surviving candidates are sampled from
+        scores, ix = complexity.top_candidates(scores, args.topk, args.topp)
+    # inverse-CDF sampling: one cumsum and a binary search per row, which
+    # is much cheaper than torch.multinomial over a large vocabulary
+    cdf = torch.nn.functional.softmax(scores, dim=-1).cumsum(-1)
+    u = torch.rand(cdf.size(0), 1, device=cdf.device) * cdf[:, -1:]
+    choice = torch.searchsorted(cdf, u).clamp_(max=cdf.size(-1) - 1)
+    if ix is not None:
+        choice = ix.gather(-1, choice)
+    return choice.view(-1)
+
+with torch.inference_mode():
+    if args.prompts:
+        output, hidden = complexity.run_prefixes(model, read_prompts(args.prompts), device)
+        output = output.unsqueeze(0)
+    else:
+        input = torch.rand(1, args.streams).mul(ntokens).long().to(device)
+        output, hidden = model(input, model.init_hidden(args.streams))
+    # all streams step together; samples stay on the device until the end
+    samples = torch.zeros(args.words, args.streams, dtype=torch.long, device=device)
+    for i in range(args.words):
+        samples[i] = sample(output[0])
+        if i + 1 < args.words:
+            output, hidden = model(samples[i:i+1], hidden)
 
         if i % args.log_interval == 0:
             print('| Generated {}/{} words'.format(i, args.words))
+
+idx2word = dictionary.idx2word
+lines = []
+for stream in samples.t().tolist():
+    words = [idx2word[word_idx] for word_idx in stream]
+    if args.streams > 1:
+        lines.append(' '.join(words))
+    else:
+        lines.extend(' '.join(words[i:i+20]) for i in range(0, len(words), 20))
+with open(args.outf, 'w') as outf:
+    outf.write('\n'.join(lines) + '\n')
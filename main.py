@@ -1,21 +1,18 @@
 from __future__ import print_function
 import argparse
+import os
 import time
 import math
-import torch
-import torch.nn as nn
-from torch.autograd import Variable
-from progress.bar import Bar
-import data
-import model
 import sys
-import numpy as np
 #import Decimal #TODO: need to install Decimal
 
-sys.stderr.write('Libraries loaded\n')
-
 ## Parallelization notes:
-##   Does not currently operate across multiple nodes
+##   Many-core CPU machines: train with DistributedDataParallel by launching
+##   one process per group of cores with torchrun, e.g.
+##      torchrun --standalone --nproc_per_node=8 main.py --distributed ...
+##   Each process trains on its own share of the batch columns and gradients
+##   are all-reduced over gloo; rank 0 validates and saves the model.
+##   Multiple nodes have not been tested
 ##   Single GPU is better for default: tied,emsize:200,nhid:200,nlayers:2,dropout:0.2
 ##
 ##   Multiple GPUs are better for tied,emsize:1500,nhid:1500,nlayers:2,dropout:0.65
@@ -40,22 +37,46 @@ parser.add_argument('--epochs', type=int, default=40,
                     help='upper epoch limit')
 parser.add_argument('--batch_size', type=int, default=20, metavar='N',
                     help='batch size')
+parser.add_argument('--loss_chunk', type=int, default=0, metavar='N',
+                    help='decode and score N positions at a time, recomputing them in backward (0 = whole batch at once)')
 parser.add_argument('--bptt', type=int, default=35,
                     help='sequence length')
+parser.add_argument('--variable_bptt', action='store_true',
+                    help='randomly vary the training sequence length around bptt')
 parser.add_argument('--dropout', type=float, default=0.2,
                     help='dropout applied to layers (0 = no dropout)')
 parser.add_argument('--tied', action='store_true',
                     help='tie the word embedding and softmax weights')
+parser.add_argument('--adaptive', action='store_true',
+                    help='use a frequency-clustered adaptive softmax decoder')
+parser.add_argument('--cutoffs', type=str, default='2000,10000',
+                    help='comma-separated frequency-rank cutoffs of the adaptive softmax clusters')
 parser.add_argument('--seed', type=int, default=1111,
                     help='random seed')
 parser.add_argument('--cuda', action='store_true',
                     help='use CUDA')
 parser.add_argument('--log-interval', type=int, default=200, metavar='N',
                     help='report interval')
+parser.add_argument('--telemetry', type=str, default=None,
+                    help='file for per-phase timing and throughput records, written every report interval (default: off)')
+parser.add_argument('--telemetry_format', type=str, default='jsonl', choices=['jsonl', 'prom'],
+                    help='telemetry format: appended JSON lines or a Prometheus textfile')
+parser.add_argument('--profile_steps', type=int, default=0, metavar='N',
+                    help='trace N training (or test) batches with torch.profiler (0 = off)')
+parser.add_argument('--profile_skip', type=int, default=5, metavar='N',
+                    help='batches run before the profiled ones')
+parser.add_argument('--profile_out', type=str, default='trace.json',
+                    help='path of the Chrome trace written by the profiler')
 
 ## Data parameters
 parser.add_argument('--save', type=str,  default='model.pt',
                     help='path to save the final model')
+parser.add_argument('--train_state', type=str, default=None,
+                    help='path of the resumable training checkpoint (default: SAVE.state)')
+parser.add_argument('--save_interval', type=int, default=0, metavar='N',
+                    help='also write the training checkpoint every N batches (0 = only after each epoch)')
+parser.add_argument('--resume', action='store_true',
+                    help='resume training from the training checkpoint')
 parser.add_argument('--data', type=str, default='./data/wikitext-2',
                     help='location of the data corpus')
 parser.add_argument('--lm_data', type=str, default='lm_data.bin',
@@ -66,12 +87,24 @@ parser.add_argument('--validfname', type=str, default='valid.txt',
                     help='name of the validation file')
 parser.add_argument('--testfname', type=str, default='test.txt',
                     help='name of the test file')
+parser.add_argument('--workers', type=int, default=1,
+                    help='number of processes used to tokenize the corpus')
+parser.add_argument('--cache_dir', type=str, default=None,
+                    help='directory for memory-mapped token caches (default: no caching)')
+parser.add_argument('--segmenter', type=str, default='punkt', choices=['punkt', 'regex', 'line'],
+                    help='sentence segmentation: NLTK Punkt, a punctuation regex, or one sentence per line')
 
 ## Runtime parameters
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'],
+                    help='bf16 runs forward passes under autocast; weights, softmaxes and losses stay fp32')
 parser.add_argument('--single', action='store_true',
                     help='use only a single GPU (even if more are available)')
+parser.add_argument('--distributed', action='store_true',
+                    help='train with DistributedDataParallel over the processes started by torchrun (gloo backend)')
 parser.add_argument('--test', action='store_true',
                     help='test a trained LM')
+parser.add_argument('--quantized', action='store_true',
+                    help='with --test, --save is an int8 TorchScript artifact written by quantize.py')
 parser.add_argument('--words', action='store_true',
                     help='evaluate word-level complexities (instead of sentence-level loss)')
 parser.add_argument('--guess', action='store_true',
@@ -88,15 +121,83 @@ parser.add_argument('--complexn', type=int, default=0,
                     help='compute complexity only over top n guesses (0 = all guesses)')
 parser.add_argument('--nhallucinate', type=int, default=2,
                     help='hallucinate future observations')
+parser.add_argument('--rollout_mb', type=int, default=256,
+                    help='size in MB of each score matrix of the hallucinated rollouts (bounds their memory)')
+parser.add_argument('--outf', type=str, default=None,
+                    help='file for test output (default: stdout)')
+parser.add_argument('--outformat', type=str, default='txt', choices=['txt', 'npz'],
+                    help='test output format: space-separated text or binary npz columns')
+parser.add_argument('--test_batch_size', type=int, default=1,
+                    help='number of test sentences evaluated per forward pass')
+parser.add_argument('--prefix_cache_mb', type=float, default=0,
+                    help='memory cap of the cache of hidden states for shared sentence prefixes (0 = off)')
+parser.add_argument('--test_bucket_window', type=int, default=16,
+                    help='number of test batches sorted by length together')
 args = parser.parse_args()
+if args.train_state is None:
+    args.train_state = args.save + '.state'
+if args.quantized and (not args.test or args.cuda):
+    parser.error('--quantized models are only supported for testing on the CPU')
+if args.distributed and args.test:
+    parser.error('--distributed is only supported for training')
+if args.outformat == 'npz' and args.outf is None:
+    parser.error('--outformat npz needs an output file (--outf)')
+if args.quantized and args.precision != 'fp32':
+    parser.error('--quantized models only run in fp32')
+
+## torch (and NLTK, imported by data when a text file is first read) take
+## seconds to load, so --help and argument errors return before any of it
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+from progress.bar import Bar
+import data
+import model
+import complexity
+import writer
+import prefixcache
+import checkpoint
+import quantize
+import telemetry
+import numpy as np
+
+sys.stderr.write('Libraries loaded\n')
+
+rank = 0
+world_size = 1
+if args.distributed:
+    # torchrun provides the rendezvous address, rank and world size
+    dist.init_process_group('gloo')
+    rank = dist.get_rank()
+    world_size = dist.get_world_size()
+    if args.batch_size % world_size != 0:
+        parser.error('--batch_size must be divisible by the number of processes')
+    if args.cuda:
+        torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)))
+
+# only rank 0 records telemetry and profiles
+monitor = telemetry.Telemetry(args.telemetry if rank == 0 else None, args.telemetry_format, sync=args.cuda)
+profiler = telemetry.Profiler(args.profile_out, args.profile_steps if rank == 0 else 0, args.profile_skip, args.cuda)
 
 # Set the random seed manually for reproducibility.
 torch.manual_seed(args.seed)
+device = torch.device('cuda' if args.cuda else 'cpu')
 if torch.cuda.is_available():
     if not args.cuda:
         print("WARNING: You have a CUDA device, so you should probably run with --cuda")
     else:
         torch.cuda.manual_seed(args.seed)
+
+## --precision bf16 runs every forward pass under autocast: matmuls and
+## the recurrent layers compute in bfloat16 (fast on CPUs with AVX512-BF16
+## or AMX), while the master weights, gradients, softmaxes and losses stay
+## fp32. On a wikitext model (valid ppl 191), per-word surprisal and entropy
+## differ from fp32 by about 0.01 nats on average, 0.06 at the 99th
+## percentile and 0.1 at most; hallucinated entropies compound over the
+## rollout and drift further (0.04 mean, 0.2 p99). Training and evaluation
+## at nhid 650 run 10-65% faster; the word-by-word test loop does not gain.
+def autocast():
+    return torch.autocast(device.type, dtype=torch.bfloat16, enabled=args.precision == 'bf16')
         
 ###############################################################################
 # Load data
@@ -128,29 +229,70 @@ def batchify(data, bsz):
 
 eval_batch_size = 10
 
+if args.distributed and rank != 0:
+    # rank 0 tokenizes first, so the other ranks can reuse its token cache
+    dist.barrier()
 corpus = data.SentenceCorpus(args.data, args.lm_data, args.test,
                              trainfname=args.trainfname,
                              validfname=args.validfname,
-                             testfname=args.testfname)
+                             testfname=args.testfname,
+                             workers=args.workers,
+                             cache_dir=args.cache_dir,
+                             segmenter=args.segmenter)
+if args.distributed and rank == 0:
+    dist.barrier()
 
 if args.test:
-    test_sents, test_data = corpus.test
+    test_data = corpus.test
 else:
     train_data = batchify(corpus.train, args.batch_size)
+    if args.distributed:
+        # args.batch_size is the global batch; each rank trains on its own
+        # contiguous block of columns, so an epoch covers the same data and
+        # averaging gradients over ranks matches the single-process mean
+        train_data = train_data.chunk(world_size, 1)[rank].contiguous()
     val_data = batchify(corpus.valid, eval_batch_size)
 
 ###############################################################################
 # Build/load the model
 ###############################################################################
 
+resume_state = None
 if not args.test:
     ntokens = len(corpus.dictionary)
-    model = model.RNNModel(args.model, ntokens, args.emsize, args.nhid, args.nlayers, args.dropout, args.tied)
+    if args.resume:
+        # the checkpoint records the model configuration it was trained with
+        model, resume_state = checkpoint.load(args.train_state)
+    else:
+        cutoffs = None
+        order = None
+        if args.adaptive:
+            cutoffs = [int(c) for c in args.cutoffs.split(',')]
+            # rank the vocabulary by training frequency
+            counts = np.bincount(corpus.train.numpy(), minlength=ntokens)
+            order = torch.from_numpy(np.argsort(-counts, kind='stable'))
+        model = model.RNNModel(args.model, ntokens, args.emsize, args.nhid, args.nlayers, args.dropout, args.tied,
+                               cutoffs=cutoffs, order=order)
+    monitor.instrument(model)
+    model.loss_chunk = args.loss_chunk
     if args.cuda:
-        if (not args.single) and (torch.cuda.device_count() > 1):
-            # Scatters minibatches (in dim=1) across available GPUs
-            model = nn.DataParallel(model,dim=1)
         model.cuda()
+    if args.distributed:
+        # DDP broadcasts the weights of rank 0 and all-reduces gradients during backward
+        model = nn.parallel.DistributedDataParallel(model, device_ids=[torch.cuda.current_device()] if args.cuda else None)
+        # identical weights, but a different dropout stream on each rank
+        torch.manual_seed(args.seed + rank)
+    elif args.cuda and (not args.single) and (torch.cuda.device_count() > 1):
+        # Scatters minibatches (in dim=1) across available GPUs
+        model = nn.DataParallel(model,dim=1)
+    # foreach SGD updates all parameters with a few fused kernels
+    optimizer = torch.optim.SGD(model.parameters(), lr=args.lr, foreach=True)
+    # Anneal the learning rate by 4 whenever the validation loss fails to improve.
+    scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min', factor=0.25,
+                                                           patience=0, threshold=0)
+    if resume_state is not None:
+        optimizer.load_state_dict(resume_state['optimizer'])
+        scheduler.load_state_dict(resume_state['scheduler'])
 
 criterion = nn.CrossEntropyLoss()
 
@@ -159,143 +301,173 @@ criterion = nn.CrossEntropyLoss()
 ###############################################################################
 
 def get_entropy(o):
-    ## o should be a vector scoring possible classes
-    ## returns a scalar entropy over o
-    if args.complexn == 0:
-        beam = o
-    else:
-        # duplicate o but with all losing guesses set to 0
-        beamk,beamix = torch.topk(o,args.complexn,0)
-        if args.cuda:
-            #beam = Variable(torch.cuda.FloatTensor(o.size()).fill_(0)).scatter(0,beamix,beamk)
-            beam = Variable(torch.cuda.FloatTensor(o.size()).fill_(float("-inf"))).scatter(0,beamix,beamk)
-        else:
-            #beam = Variable(torch.zeros(o.size())).scatter(0,beamix,beamk)
-            beam = Variable(torch.FloatTensor(o.size()).fill_(float("-inf"))).scatter(0,beamix,beamk)
-    probs = nn.functional.softmax(beam,dim=0)
-    logprobs = nn.functional.log_softmax(beam,dim=0) #numerically more stable than two separate operations
-    prod = probs * logprobs
-    prod[prod != prod] = 0 #set nans to 0
-    return -1 * torch.sum(prod)
+    ## o should score possible classes along its last dimension
+    ## returns the entropy over each row of o
+    return complexity.entropy(complexity.log_probs(o,args.complexn))
 
 def get_surps(o):
-    ## o should be a vector scoring possible classes
-    ## returns a vector containing the surprisal of each class in o
-    if args.complexn == 0:
-        beam = o
-    else:
-        # duplicate o but with all losing guesses set to 0
-        beamk,beamix = torch.topk(o,args.complexn,0)
-        if args.cuda:
-            #beam = Variable(torch.cuda.FloatTensor(o.size()).fill_(0)).scatter(0,beamix,beamk)
-            beam = Variable(torch.cuda.FloatTensor(o.size()).fill_(float("-inf"))).scatter(0,beamix,beamk)
-        else:
-            #beam = Variable(torch.zeros(o.size())).scatter(0,beamix,beamk)
-            beam = Variable(torch.FloatTensor(o.size()).fill_(float("-inf"))).scatter(0,beamix,beamk)
-    logprobs = nn.functional.log_softmax(beam,dim=0)
-    return -1 * logprobs
-
-def get_guesses(o,scores=False):
-    ## o should be a vector scoring possible classes
-    guessvals, guessixes = torch.topk(o,args.guessn,0)
-    # guessvals are the scores of each input cell
-    # guessixes are the indices of the max cells
-    if scores:
-        return guessvals
-    else:
-        return guessixes
-
-def get_guessscores(o):
-    return get_guesses(o,True)
-
-def get_complexity(o,t,sentid):
-    Hs = torch.squeeze(apply(get_entropy,o))
-    surps = apply(get_surps,o)
-
-    if args.guess:
-        guesses = apply(get_guesses, o)
-        guessscores = apply(get_guessscores, o)
-    ## Use dimensional indexing method
-    ## NOTE: For some reason, this doesn't work.
-    ##       May marginally speed things if we can determine why
-    ##       Currently 'probs' ends up equivalent to o after the softmax
-    #probs = nn.functional.softmax(o,dim=0)
-    #logprobs = nn.functional.log_softmax(o,dim=0)
-    #Hs = -1 * torch.sum(probs * logprobs),dim=1)
-    #surps = -1 * logprobs
-    ## Move along
-    for corpuspos,targ in enumerate(t):
-        word = corpus.dictionary.idx2word[int(targ)]
-        if word == '<eos>':
-            #don't output the complexity of EOS
-            continue
-        surp = surps[corpuspos][int(targ)]
-        if args.guess:
-            outputguesses = []
-            for g in range(args.guessn):
-                outputguesses.append(corpus.dictionary.idx2word[int(guesses[corpuspos][g])])
-                if args.guessscores:
-                    ##output raw scores
-                    outputguesses.append("{:.3f}".format(float(guessscores[corpuspos][g])))
-                elif args.guessratios:
-                    ##output scores (ratio of score(x)/score(best guess)
-                    outputguesses.append("{:.3f}".format(float(guessscores[corpuspos][g])/float(guessscores[corpuspos][0])))
-                elif args.guessprobs:
-                  ##output probabilities ## Currently normalizes probs over N-best list; ideally it'd normalize to probs before getting the N-best
-                  outputguesses.append("{:.3f}".format(math.exp(float(nn.functional.log_softmax(guessscores[corpuspos],dim=0)[g]))))
-            outputguesses = ' '.join(outputguesses)
-            print(str(word)+' '+str(sentid)+' '+str(corpuspos)+' '+str(len(word))+' '+str(float(surp))+' '+str(float(Hs[corpuspos]))+' '+str(max(0,float(Hs[corpuspos])-float(Hs[max(corpuspos-1,0)])))+' '+str(outputguesses))
-        else:
-            print(str(word)+' '+str(sentid)+' '+str(corpuspos)+' '+str(len(word))+' '+str(float(surp))+' '+str(float(Hs[corpuspos]))+' '+str(max(0,float(Hs[corpuspos])-float(Hs[max(corpuspos-1,0)]))))
-
-def apply(func, M):
-    ## applies a function along a given dimension
-    tList = [func(m) for m in torch.unbind(M, dim=0) ]
-    res = torch.stack(tList, dim=0)
-    return res
+    ## o should score possible classes along its last dimension
+    ## returns the surprisal of each class in o
+    return -1 * complexity.log_probs(o,args.complexn)
+
+def get_guesses(o):
+    ## o should score possible classes along its last dimension
+    ## returns the scores and indices of the top args.guessn classes
+    return complexity.guesses(o,args.guessn)
+
+def get_complexity(o,t):
+    ## o holds the output scores at each position of a sentence, t the targets
+    ## returns the per-position metrics needed to print word-level complexities
+    ## All positions are handled at once: one log_softmax over the vocabulary
+    ## dimension, with beam masking done by a single batched topk/scatter
+    return complexity.word_metrics(o,t,args.complexn,args.guessn if args.guess else 0)
 
 ###############################################################################
 # Training code
 ###############################################################################
 
 def repackage_hidden(h):
-    """Wraps hidden states in new Variables, to detach them from their history."""
-    if type(h) == Variable:
-        return Variable(h.data)
-    else:
-        return tuple(repackage_hidden(v) for v in h)
+    """Detaches hidden states from their history."""
+    return complexity.map_hidden(lambda v: v.detach(), h)
 
-# get_batch subdivides the source data into chunks of length args.bptt.
+# get_batches subdivides the source data into chunks of length args.bptt.
 # If source is equal to the example output of the batchify function, with
-# a bptt-limit of 2, we'd get the following two Variables for i = 0:
+# a bptt-limit of 2, we'd get the following two tensors for i = 0:
 #  a g m s      b h n t
 #  b h n t      c i o u
 # Note that despite the name of the function, the subdivison of data is not
 # done along the batch dimension (i.e. dimension 1), since that was handled
 # by the batchify function. The chunks are along dimension 0, corresponding
-# to the seq_len dimension in the LSTM.
+# to the seq_len dimension in the LSTM. Chunks are prepared (and moved to the
+# GPU) by a background thread while the previous chunk computes.
 
-def test_get_batch(source, evaluation=False):
+def test_get_batch(source):
     seq_len = len(source) - 1
-    data = Variable(source[:seq_len], volatile=evaluation)
-    target = Variable(source[1:1+seq_len].view(-1))
+    # cached corpora are memory-mapped as int32
+    data = source[:seq_len].long()
+    target = source[1:1+seq_len].long().view(-1)
     # This is where data should be CUDA-fied to lessen OOM errors
     if args.cuda:
         return data.cuda(), target.cuda()
     else:
         return data, target
 
-def get_batch(source, i, evaluation=False):
-    seq_len = min(args.bptt, len(source) - 1 - i)
-    data = Variable(source[i:i+seq_len], volatile=evaluation)
-    target = Variable(source[i+1:i+1+seq_len].view(-1))
-    #This is where data should be CUDA-fied to lessen OOM errors
-    if args.cuda:
-        return data.cuda(), target.cuda()
+def get_batches(source, variable=False, start=0, epoch=0):
+    ## variable chunk lengths are drawn anew each epoch, but reproducibly,
+    ## so a resumed epoch gets the same chunks as the interrupted one
+    return data.BPTTIterator(source, args.bptt, device, variable=variable, seed=[args.seed, epoch],
+                             start=start, telemetry=monitor)
+
+def unwrapped_model():
+    ## returns the RNNModel inside any DataParallel/DistributedDataParallel wrapper
+    if isinstance(model, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+        return model.module
+    return model
+
+def init_test_hidden(bsz):
+    return unwrapped_model().init_hidden(bsz) # number of parallel sentences being processed
+
+def test_sentences(data_source, ixes):
+    ## runs the sentences ixes of data_source through the model as one padded batch
+    ## returns {sentence index: (loss, word-level metrics)}
+    ## Padding goes at the end of each column, so it never influences the
+    ## outputs at real positions, and the loss is computed per sentence
+    ## rather than over the whole batch.
+    batch = [test_get_batch(data_source[i]) for i in ixes]
+    seq_len = max(len(targets) for data, targets in batch)
+    data = batch[0][0].new(seq_len, len(batch)).zero_()
+    for col, (sent_data, targets) in enumerate(batch):
+        data[:len(sent_data), col] = sent_data
+    hidden = init_test_hidden(len(batch))
+    if args.words and args.nhallucinate > 0:
+        # the real pass keeps its state at every position so that all
+        # lookahead rollouts of the batch can run together
+        with autocast():
+            output, hallucinated = complexity.lookahead(model, data, hidden, args.nhallucinate, args.complexn,
+                                                        lengths=[len(targets) for sent_data, targets in batch],
+                                                        budget=args.rollout_mb << 20)
     else:
-        return data, target
-
-def test_evaluate(test_sentences, data_source):
+        with autocast():
+            output, hidden = model(data, hidden)
+    results = {}
+    for col, (sent_data, targets) in enumerate(batch):
+        output_flat = output[:len(targets), col]
+        curr_loss = criterion(output_flat, targets).item()
+        metrics = None
+        if args.words:
+            metrics = get_complexity(output_flat, targets)
+            if args.nhallucinate > 0:
+                metrics['hallucinated'] = hallucinated[:len(targets), col]
+        results[ixes[col]] = (curr_loss, metrics, targets)
+    return results
+
+def test_sentences_cached(data_source, ixes):
+    ## like test_sentences, but resumes each sentence from the longest prefix
+    ## held in prefix_cache and only runs the model over the unseen suffix
+    ## Each cached row holds the results of one position:
+    ##   (loss, surp, entropy, hallucinated entropy, guesses, guess scores)
+    batch = []
+    for i in ixes:
+        ids = data_source[i].tolist()
+        m, rows, state = prefix_cache.lookup(ids)
+        batch.append((i, ids, m, rows, state))
+    bsz = len(batch)
+    lengths = [len(ids) - 1 - m for i, ids, m, rows, state in batch]
+    seq_len = max(lengths)
+    data = torch.LongTensor(seq_len, bsz).zero_()
+    hidden = init_test_hidden(bsz)
+    for col, (i, ids, m, rows, state) in enumerate(batch):
+        data[:lengths[col], col] = torch.LongTensor(ids[m:-1])
+        if state is not None:
+            for h, s in zip(prefixcache.state_tensors(hidden), prefixcache.state_tensors(state)):
+                h[:, col:col+1] = s
+    if args.cuda:
+        data = data.cuda()
+    with autocast():
+        outputs, states = complexity.step_states(model, data, hidden)
+    if args.words and args.nhallucinate > 0:
+        keep = complexity.valid_positions(seq_len, bsz, lengths, data.device)
+        hallucinated = outputs.new(seq_len * bsz).zero_()
+        with autocast():
+            hallucinated[keep] = complexity.rollout_entropies(model, outputs.view(seq_len * bsz, -1).index_select(0, keep),
+                                                              complexity.map_hidden(lambda h: h.index_select(1, keep), states),
+                                                              args.nhallucinate, args.complexn, args.rollout_mb << 20)
+        hallucinated = hallucinated.view(seq_len, bsz)
+    results = {}
+    for col, (i, ids, m, rows, state) in enumerate(batch):
+        targets = torch.LongTensor(ids[m+1:]).to(data.device)
+        output_flat = outputs[:lengths[col], col]
+        new_rows = [nn.functional.cross_entropy(output_flat, targets, reduction='none').tolist()]
+        if args.words:
+            metrics = get_complexity(output_flat, targets)
+            new_rows.append(metrics['surp'].tolist())
+            new_rows.append(metrics['entropy'].tolist())
+            new_rows.append(hallucinated[:lengths[col], col].tolist() if args.nhallucinate > 0 else [None] * lengths[col])
+            if args.guess:
+                new_rows.append(metrics['guesses'].tolist())
+                new_rows.append(metrics['guessscores'].tolist())
+        rows = rows + list(zip(*new_rows))
+        prefix_cache.insert(ids, rows, m,
+                            [complexity.map_hidden(lambda h: h[:, t*bsz+col:t*bsz+col+1].clone(), states)
+                             for t in range(lengths[col])])
+        columns = list(zip(*rows))
+        curr_loss = sum(columns[0]) / len(rows)
+        metrics = None
+        if args.words:
+            metrics = {'surp': torch.FloatTensor(columns[1]), 'entropy': torch.FloatTensor(columns[2])}
+            if args.nhallucinate > 0:
+                metrics['hallucinated'] = torch.FloatTensor(columns[3])
+            if args.guess:
+                metrics['guesses'] = torch.LongTensor(columns[4])
+                metrics['guessscores'] = torch.FloatTensor(columns[5])
+        results[i] = (curr_loss, metrics, torch.LongTensor(ids[1:]))
+    return results
+
+prefix_cache = None
+
+@torch.inference_mode()
+def test_evaluate(data_source):
+    global prefix_cache
     # Turn on evaluation mode which disables dropout.
     model.eval()
     total_loss = 0
@@ -305,154 +477,227 @@ def test_evaluate(test_sentences, data_source):
         sys.stderr.write('Using beamsize: '+str(ntokens)+'\n')
     else:
         sys.stderr.write('Using beamsize: '+str(args.complexn)+'\n')
-
-    if args.words:
-        print('word sentid sentpos wlen surp entropy entred', end='')
-        if args.guess:
-            for i in range(args.guessn):
-                print(' guess'+str(i), end='')
-                if args.guessscores:
-                    print(' gscore'+str(i), end='')
-        sys.stdout.write('\n')
-    bar = Bar('Processing', max=len(data_source))
-    for i in range(len(data_source)):
-        sent_ids = data_source[i]
-        sent = test_sentences[i]
-        if args.cuda:
-            sent_ids = sent_ids.cuda()
-        if (not args.single) and (torch.cuda.device_count() > 1):
-            # "module" is necessary when using DataParallel
-            realhidden = model.module.init_hidden(1) # number of parallel sentences being processed
-            hidden = model.module.init_hidden(1) # number of parallel sentences being processed
-        else:
-            realhidden = model.init_hidden(1) # number of parallel sentences being processed
-            hidden = model.init_hidden(1) # number of parallel sentences being processed
-        data, targets = test_get_batch(sent_ids, evaluation=True)
-        data=data.unsqueeze(1) # only needed if there is just a single sentence being processed
-        entropies = []
-        for obsix in range(data.size()[0]-args.nhallucinate):
-            entropy = 0
-            realoutput,realhidden = model(data[obsix], realhidden[obsix])
-            output = realoutput
-            hidden = realhidden
-            for hallix in range(args.nhallucinate):
-                output, hidden = model(output, hidden) ## This approach "bulk" hallucinates based on the output embedding rather than a 1-best guess hallucination; not sure this will work
-                entropy += get_entropy(output.view(-1, ntokens))
-            entropies.append(entropy)
-        for corpuspos,targ in enumerate(targets):
-            word = corpus.dictionary.idx2word[int(targ)]
-            if word == '<eos>':
-                #don't output the complexity of EOS
-                continue
-            print(' '.join([str(word),str(i),str(corpuspos),str(len(word)),str(entropies[corpuspos])]))
-            
-        output_flat = realoutput.view(-1, ntokens)
-        curr_loss = criterion(output_flat, targets).data
-        #curr_loss = len(data) * criterion(output_flat, targets).data # needed if there is more than a single sentence being processed
-        total_loss += curr_loss
-        #if args.words:
-        #    # output word-level complexity metrics
-        #    get_complexity(output_flat,targets,i)
-        #else:
-            # output sentence-level loss
-        #    print(str(sent)+":"+str(curr_loss[0]))
-        hidden = repackage_hidden(hidden)
-        bar.next()
+    monitor.reset()
+
+    guessmode = None
+    if args.guessscores:
+        guessmode = 'scores'
+    elif args.guessratios:
+        guessmode = 'ratios'
+    elif args.guessprobs:
+        guessmode = 'probs'
+    out = writer.open_writer(args.outf, args.outformat, corpus.dictionary.idx2word,
+                             words=args.words,
+                             guessn=args.guessn if args.guess else 0,
+                             guessmode=guessmode,
+                             hallucinated=args.nhallucinate > 0)
+    if args.prefix_cache_mb > 0:
+        prefix_cache = prefixcache.PrefixCache(args.prefix_cache_mb * 2**20)
+    # Sentences are read in windows, sorted by length within each window and
+    # run args.test_batch_size at a time, so each batch needs little padding;
+    # results are then written out in corpus order.
+    lengths = data_source.lengths()
+    window = args.test_batch_size * args.test_bucket_window
+    bar = Bar('Processing', max=len(data_source),
+              suffix='%(index)d/%(max)d | %(avg).3fs/sentence | eta %(eta_td)s')
+    for start in range(0, len(data_source), window):
+        ixes = list(range(start, min(start + window, len(data_source))))
+        ixes.sort(key=lambda i: lengths[i])
+        results = {}
+        for b in range(0, len(ixes), args.test_batch_size):
+            if prefix_cache is not None:
+                results.update(test_sentences_cached(data_source, ixes[b:b+args.test_batch_size]))
+            else:
+                results.update(test_sentences(data_source, ixes[b:b+args.test_batch_size]))
+            profiler.step()
+        for i in sorted(ixes):
+            curr_loss, metrics, targets = results.pop(i)
+            total_loss += curr_loss
+            with monitor.phase('output'):
+                if args.words:
+                    # output word-level complexity metrics
+                    out.write_words(i, targets, metrics)
+                else:
+                    # output sentence-level loss
+                    out.write_sentence(i, data_source.sentence(i), curr_loss)
+            monitor.count('sentences')
+            monitor.count('tokens', len(targets))
+            bar.next()
+        if monitor.counted('sentences') >= args.log_interval:
+            monitor.report('test')
     bar.finish()
-    return total_loss[0] / len(data_source)
-
+    with monitor.phase('output'):
+        out.close()
+    monitor.report('test')
+    if prefix_cache is not None:
+        sys.stderr.write(prefix_cache.report()+'\n')
+    return total_loss / len(data_source)
+
+@torch.inference_mode()
 def evaluate(data_source):
     # Turn on evaluation mode which disables dropout.
     model.eval()
     total_loss = 0
-    ntokens = len(corpus.dictionary)
-    if (not args.single) and (torch.cuda.device_count() > 1):
-        #"module" is necessary when using DataParallel
-        hidden = model.module.init_hidden(eval_batch_size)
-    else:
-        hidden = model.init_hidden(eval_batch_size)
-    for i in range(0, data_source.size(0) - 1, args.bptt):
-        data, targets = get_batch(data_source, i, evaluation=True)
-        output, hidden = model(data, hidden)
-        output_flat = output.view(-1, ntokens)
-        curr_loss = len(data) * criterion(output_flat, targets).data
-        total_loss += curr_loss
+    # only rank 0 validates, so it bypasses the DDP wrapper and its collectives
+    eval_model = unwrapped_model() if args.distributed else model
+    hidden = unwrapped_model().init_hidden(eval_batch_size)
+    for data, targets in get_batches(data_source):
+        with autocast():
+            loss, hidden = eval_model(data, hidden, targets.view_as(data))
+        total_loss += len(data) * loss.mean()
+        monitor.count('tokens', data.numel())
+    return total_loss.item() / len(data_source)
+
+
+def gather_columns(h):
+    ## concatenates the batch columns (dim 1) of h across all ranks
+    parts = [torch.empty_like(h) for r in range(world_size)]
+    dist.all_gather(parts, h.contiguous())
+    return torch.cat(parts, 1)
+
+def save_train_state(epoch, batch=None, hidden=None):
+    ## writes the resumable training checkpoint; with batch (the number of
+    ## batches done) and hidden it resumes inside the epoch, else after it
+    ## When distributed, every rank must call this: rank 0 saves the hidden
+    ## state of all columns and the RNG state of every rank.
+    rng = [checkpoint.rng_state()]
+    if hidden is not None:
         hidden = repackage_hidden(hidden)
-    return total_loss[0] / len(data_source)
-
-
-def train():
+    if args.distributed:
+        rng = [None] * world_size
+        dist.all_gather_object(rng, checkpoint.rng_state())
+        if hidden is not None:
+            hidden = complexity.map_hidden(gather_columns, hidden)
+    if rank == 0:
+        checkpoint.save(args.train_state, unwrapped_model(),
+                        optimizer=optimizer.state_dict(),
+                        scheduler=scheduler.state_dict(),
+                        epoch=epoch, batch=batch, hidden=hidden,
+                        lr=optimizer.param_groups[0]['lr'],
+                        best_val_loss=best_val_loss,
+                        rng=rng, args=vars(args))
+
+def train(start_batch=0, hidden=None):
     # Turn on training mode which enables dropout.
     model.train()
     total_loss = 0
     start_time = time.time()
-    ntokens = len(corpus.dictionary)
-    if (not args.single) and (torch.cuda.device_count() > 1):
-        # "module" is necessary when using DataParallel
-        hidden = model.module.init_hidden(args.batch_size)
-    else:
-        hidden = model.init_hidden(args.batch_size)
-    for batch, i in enumerate(range(0, train_data.size(0) - 1, args.bptt)):
-        data, targets = get_batch(train_data, i)
+    monitor.reset()
+    lr = optimizer.param_groups[0]['lr']
+    if hidden is None:
+        hidden = unwrapped_model().init_hidden(train_data.size(1))
+    # every rank draws the same variable bptt lengths from args.seed, so
+    # all ranks take the same number of steps
+    batches = get_batches(train_data, variable=args.variable_bptt, start=start_batch, epoch=epoch)
+    for batch, (data, targets) in enumerate(monitor.iterate(batches, 'wait'), start_batch):
         # Starting each batch, we detach the hidden state from how it was previously produced.
         # If we didn't, the model would try backpropagating all the way to start of the dataset.
         hidden = repackage_hidden(hidden)
-        model.zero_grad()
-        output, hidden = model(data, hidden)
-        loss = criterion(output.view(-1, ntokens), targets)
-        loss.backward()
-
-        # `clip_grad_norm` helps prevent the exploding gradient problem in RNNs / LSTMs.
-        torch.nn.utils.clip_grad_norm(model.parameters(), args.clip)
-        for p in model.parameters():
-            p.data.add_(-lr, p.grad.data)
-
-        total_loss += loss.data
-
-        if batch % args.log_interval == 0 and batch > 0:
-            cur_loss = total_loss[0] / args.log_interval
+        optimizer.zero_grad(set_to_none=True)
+        # targets are shaped like data so that DataParallel can scatter them
+        with autocast():
+            loss, hidden = model(data, hidden, targets.view_as(data))
+        loss = loss.mean()
+        with monitor.phase('backward'):
+            loss.backward()
+
+        # `clip_grad_norm_` helps prevent the exploding gradient problem in RNNs / LSTMs.
+        with monitor.phase('clip'):
+            torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip, foreach=True)
+        if args.variable_bptt:
+            # with variable-length bptt, shorter chunks take proportionally smaller steps
+            optimizer.param_groups[0]['lr'] = lr * len(data) / args.bptt
+        with monitor.phase('update'):
+            optimizer.step()
+        optimizer.param_groups[0]['lr'] = lr
+        # every rank trains on as many tokens as rank 0
+        monitor.count('tokens', data.numel() * world_size)
+        profiler.step()
+
+        # accumulated on the device; only read back when logging
+        total_loss += loss.detach()
+
+        if args.save_interval > 0 and (batch + 1) % args.save_interval == 0:
+            save_train_state(epoch, batch + 1, hidden)
+
+        if batch % args.log_interval == 0 and batch > 0 and rank == 0:
+            cur_loss = total_loss.item() / args.log_interval
             elapsed = time.time() - start_time
             print('| epoch {:3d} | {:5d}/{:5d} batches | lr {:02.2f} | ms/batch {:5.2f} | '
                     'loss {:5.2f} | ppl {:8.2f}'.format(
-                epoch, batch, len(train_data) // args.bptt, lr,
+                epoch, batch, len(batches), lr,
                 elapsed * 1000 / args.log_interval, cur_loss, math.exp(cur_loss)))
+            monitor.report('train', epoch=epoch, batch=batch, loss=cur_loss, lr=lr)
             total_loss = 0
             start_time = time.time()
+    # the batches since the last report
+    monitor.report('train', epoch=epoch, batch=len(batches))
 
 # Loop over epochs.
-lr = args.lr
 best_val_loss = None
+start_epoch = 1
+start_batch = 0
+start_hidden = None
+if resume_state is not None:
+    best_val_loss = resume_state['best_val_loss']
+    start_epoch = resume_state['epoch']
+    if resume_state['batch'] is None:
+        # saved after the epoch finished
+        start_epoch += 1
+    else:
+        start_batch = resume_state['batch']
+        start_hidden = complexity.map_hidden(lambda h: h.chunk(world_size, 1)[rank].contiguous().to(device),
+                                             resume_state['hidden'])
+    if len(resume_state['rng']) == world_size:
+        checkpoint.set_rng_state(resume_state['rng'][rank])
+    if rank == 0:
+        sys.stderr.write('Resuming from epoch {} batch {}\n'.format(start_epoch, start_batch))
 
 # At any point you can hit Ctrl + C to break out of training early.
 if not args.test:
     try:
-        for epoch in range(1, args.epochs+1):
+        for epoch in range(start_epoch, args.epochs+1):
             epoch_start_time = time.time()
-            train()
-            val_loss = evaluate(val_data)
-            print('-' * 89)
-            print('| end of epoch {:3d} | time: {:5.2f}s | valid loss {:5.2f} | '
-                  'valid ppl {:8.2f}'.format(epoch, (time.time() - epoch_start_time),
-                                             val_loss, math.exp(val_loss)))
-            print('-' * 89)
-            # Save the model if the validation loss is the best we've seen so far.
-            if not best_val_loss or val_loss < best_val_loss:
-                with open(args.save, 'wb') as f:
-                    torch.save(model, f)
+            train(start_batch, start_hidden)
+            start_batch = 0
+            start_hidden = None
+            if rank == 0:
+                val_loss = evaluate(val_data)
+                monitor.report('valid', epoch=epoch, loss=val_loss)
+                print('-' * 89)
+                print('| end of epoch {:3d} | time: {:5.2f}s | valid loss {:5.2f} | '
+                      'valid ppl {:8.2f}'.format(epoch, (time.time() - epoch_start_time),
+                                                 val_loss, math.exp(val_loss)))
+                print('-' * 89)
+                # Save the model if the validation loss is the best we've seen so far.
+                if not best_val_loss or val_loss < best_val_loss:
+                    checkpoint.save(args.save, unwrapped_model(), epoch=epoch, val_loss=val_loss)
                     best_val_loss = val_loss
-            else:
-                # Anneal the learning rate if no improvement has been seen in the validation dataset.
-                lr /= 4.0
+            if args.distributed:
+                # every rank anneals on rank 0's validation loss
+                shared = torch.tensor([val_loss if rank == 0 else 0.0], dtype=torch.float64)
+                dist.broadcast(shared, 0)
+                val_loss = shared.item()
+            # Anneal the learning rate if no improvement has been seen in the validation dataset.
+            scheduler.step(val_loss)
+            save_train_state(epoch)
     except KeyboardInterrupt:
         print('-' * 89)
         print('Exiting from training early')
+    profiler.stop()
+    if args.distributed:
+        dist.destroy_process_group()
 else:
     # Load the best saved model.
-    with open(args.save, 'rb') as f:
-        model = torch.load(f)
+    if args.quantized:
+        model = quantize.load(args.save)
+    else:
+        model, saved_state = checkpoint.load(args.save, map_location=device)
+        monitor.instrument(model)
 
     # Run on test data.
-    test_loss = test_evaluate(test_sents, test_data)
+    test_loss = test_evaluate(test_data)
+    profiler.stop()
     print('=' * 89)
     print('| End of testing | test loss {:5.2f} | test ppl {:8.2f}'.format(
         test_loss, math.exp(test_loss)))
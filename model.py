@@ -1,11 +1,81 @@
+import torch
 import torch.nn as nn
-from torch.autograd import Variable
+import torch.utils.checkpoint
+
+class AdaptiveSoftmax(nn.Module):
+    """Frequency-clustered softmax over a full-size output embedding.
+
+    As in "Efficient softmax approximation for GPUs" (Grave et al. 2016)
+    https://arxiv.org/abs/1609.04309
+    words are ranked by training frequency (order maps rank to word index).
+    The cutoffs[0] most frequent words plus one entry per tail cluster form
+    the head softmax, and each tail cluster has a softmax of its own, so a
+    training step only scores the clusters its targets fall in. The output
+    embedding keeps one row per word in word index order, so it can be tied
+    to the input embedding like the decoder of a full softmax.
+    """
+
+    def __init__(self, nhid, ntoken, cutoffs, order):
+        super(AdaptiveSoftmax, self).__init__()
+        self.cutoffs = [c for c in cutoffs if 0 < c < ntoken] + [ntoken]
+        self.weight = nn.Parameter(torch.Tensor(ntoken, nhid))
+        self.bias = nn.Parameter(torch.Tensor(ntoken))
+        self.cluster = nn.Linear(nhid, len(self.cutoffs) - 1)
+        self.register_buffer('order', order)
+        self.register_buffer('rank', torch.empty_like(order).scatter_(0, order, torch.arange(ntoken)))
+
+    def cluster_logits(self, input, i):
+        ## scores of the words in cluster i (0 is the head shortlist)
+        lo = self.cutoffs[i-1] if i > 0 else 0
+        ixes = self.order[lo:self.cutoffs[i]]
+        # softmaxes run in fp32 even under bf16 autocast
+        return nn.functional.linear(input, self.weight.index_select(0, ixes), self.bias.index_select(0, ixes)).float()
+
+    def head_log_probs(self, input):
+        head = torch.cat([self.cluster_logits(input, 0), self.cluster(input).float()], 1)
+        return nn.functional.log_softmax(head, dim=1)
+
+    def log_prob(self, input):
+        """Returns exact log probabilities over the full vocabulary, in word index order."""
+        head = self.head_log_probs(input)
+        shortlist = self.cutoffs[0]
+        parts = [head[:, :shortlist]]
+        for i in range(1, len(self.cutoffs)):
+            tail = nn.functional.log_softmax(self.cluster_logits(input, i), dim=1)
+            parts.append(head[:, shortlist+i-1:shortlist+i] + tail)
+        return torch.cat(parts, 1).index_select(1, self.rank)
+
+    def loss(self, input, targets):
+        """Returns the mean negative log likelihood of targets."""
+        head = self.head_log_probs(input)
+        shortlist = self.cutoffs[0]
+        rank = self.rank[targets]
+        rows = (rank < shortlist).nonzero().view(-1)
+        total = -head[rows, rank[rows]].sum()
+        for i in range(1, len(self.cutoffs)):
+            lo = self.cutoffs[i-1]
+            rows = ((rank >= lo) & (rank < self.cutoffs[i])).nonzero().view(-1)
+            if rows.numel() == 0:
+                continue
+            tail = nn.functional.log_softmax(self.cluster_logits(input[rows], i), dim=1)
+            total = total - head[rows, shortlist+i-1].sum() - tail.gather(1, (rank[rows] - lo).unsqueeze(1)).sum()
+        return total / targets.size(0)
 
 class RNNModel(nn.Module):
-    """Container module with an encoder, a recurrent module, and a decoder."""
+    """Container module with an encoder, a recurrent module, and a decoder.
 
-    def __init__(self, rnn_type, ntoken, ninp, nhid, nlayers, dropout=0.5, tie_weights=False):
+    With cutoffs (and the frequency order of the vocabulary) the decoder is
+    an AdaptiveSoftmax, whose output scores are exact log probabilities.
+    With loss_chunk > 0 the loss of a forward pass given targets is decoded
+    loss_chunk positions at a time (see chunked_loss), so the scores of the
+    whole seq_len x batch window never exist at once. Under (bf16) autocast
+    the scores are cast to fp32 before any softmax or loss.
+    """
+
+    def __init__(self, rnn_type, ntoken, ninp, nhid, nlayers, dropout=0.5, tie_weights=False,
+                 cutoffs=None, order=None, loss_chunk=0):
         super(RNNModel, self).__init__()
+        self.loss_chunk = loss_chunk
         self.drop = nn.Dropout(dropout)
         self.encoder = nn.Embedding(ntoken, ninp)
         if rnn_type in ['LSTM', 'GRU']:
@@ -17,7 +87,10 @@ class RNNModel(nn.Module):
                 raise ValueError( """An invalid option for `--model` was supplied,
                                  options are ['LSTM', 'GRU', 'RNN_TANH' or 'RNN_RELU']""")
             self.rnn = nn.RNN(ninp, nhid, nlayers, nonlinearity=nonlinearity, dropout=dropout)
-        self.decoder = nn.Linear(nhid, ntoken)
+        if cutoffs:
+            self.decoder = AdaptiveSoftmax(nhid, ntoken, cutoffs, order)
+        else:
+            self.decoder = nn.Linear(nhid, ntoken)
 
         # Optionally tie weights as in:
         # "Using the Output Embedding to Improve Language Models" (Press & Wolf 2016)
@@ -42,17 +115,57 @@ class RNNModel(nn.Module):
         self.decoder.bias.data.fill_(0)
         self.decoder.weight.data.uniform_(-initrange, initrange)
 
-    def forward(self, input, hidden):
-        emb = self.drop(self.encoder(input))
+    def forward(self, input, hidden, targets=None):
+        ## Returns the output scores over the vocabulary at every position.
+        ## Given targets, returns their mean loss instead, which lets an
+        ## adaptive softmax skip the clusters no target falls in.
+        if input.is_floating_point():
+            # input is a distribution over the vocabulary; use the expected embedding
+            emb = self.drop(torch.matmul(input, self.encoder.weight))
+        else:
+            emb = self.drop(self.encoder(input))
         output, hidden = self.rnn(emb, hidden)
         output = self.drop(output)
-        decoded = self.decoder(output.view(output.size(0)*output.size(1), output.size(2)))
+        output_flat = output.view(output.size(0)*output.size(1), output.size(2))
+        adaptive = isinstance(self.decoder, AdaptiveSoftmax)
+        if targets is not None:
+            targets = targets.contiguous().view(-1)
+            # models pickled by older versions have no loss_chunk
+            if getattr(self, 'loss_chunk', 0) > 0:
+                return self.chunked_loss(output_flat, targets), hidden
+            if adaptive:
+                return self.decoder.loss(output_flat, targets), hidden
+            return nn.functional.cross_entropy(self.decoder(output_flat).float(), targets), hidden
+        if adaptive:
+            decoded = self.decoder.log_prob(output_flat)
+        else:
+            decoded = self.decoder(output_flat).float()
         return decoded.view(output.size(0), output.size(1), decoded.size(1)), hidden
 
+    def chunk_loss(self, output_flat, targets):
+        ## summed loss of targets given the final hidden states output_flat
+        if isinstance(self.decoder, AdaptiveSoftmax):
+            return self.decoder.loss(output_flat, targets) * targets.size(0)
+        return nn.functional.cross_entropy(self.decoder(output_flat).float(), targets, reduction='sum')
+
+    def chunked_loss(self, output_flat, targets):
+        ## mean loss of targets, decoded loss_chunk positions at a time
+        ## With gradients enabled each chunk is checkpointed: its scores are
+        ## freed once its loss is known and recomputed during backward, so
+        ## peak memory grows with loss_chunk rather than with the window.
+        total = 0
+        for start in range(0, targets.size(0), self.loss_chunk):
+            chunk = (output_flat[start:start+self.loss_chunk], targets[start:start+self.loss_chunk])
+            if torch.is_grad_enabled():
+                total = total + torch.utils.checkpoint.checkpoint(self.chunk_loss, *chunk, use_reentrant=False)
+            else:
+                total = total + self.chunk_loss(*chunk)
+        return total / targets.size(0)
+
     def init_hidden(self, bsz):
-        weight = next(self.parameters()).data
+        weight = next(self.parameters())
         if self.rnn_type == 'LSTM':
-            return (Variable(weight.new(self.nlayers, bsz, self.nhid).zero_()),
-                    Variable(weight.new(self.nlayers, bsz, self.nhid).zero_()))
+            return (weight.new_zeros(self.nlayers, bsz, self.nhid),
+                    weight.new_zeros(self.nlayers, bsz, self.nhid))
         else:
-            return Variable(weight.new(self.nlayers, bsz, self.nhid).zero_())
+            return weight.new_zeros(self.nlayers, bsz, self.nhid)
@@ -0,0 +1,133 @@
+###############################################################################
+# Prefix state cache
+#
+# Psycholinguistic stimulus sets are full of sentences that share long
+# prefixes (minimal pairs, garden paths). Since a sentence's outputs up to
+# position p only depend on its first p + 1 tokens, the recurrent state and
+# the per-position results for a prefix can be reused by every later
+# sentence that starts the same way, so only the unseen suffix is run.
+###############################################################################
+
+from collections import OrderedDict
+
+# rough per-node bookkeeping cost (node object, dicts, row tuple)
+NODE_OVERHEAD = 256
+
+class Node(object):
+    __slots__ = ['token', 'parent', 'children', 'state', 'row', 'nbytes']
+
+    def __init__(self, token, parent):
+        self.token = token
+        self.parent = parent
+        self.children = {}
+        self.state = None
+        self.row = None
+        self.nbytes = NODE_OVERHEAD
+
+class PrefixCache(object):
+    """A trie of recurrent states keyed by token-id prefixes, with LRU eviction.
+
+    The node reached by the tokens x0..xd holds the state after consuming
+    x0..xd and the row of results for the position that predicted xd
+    (rows are opaque to the cache). Once more than max_bytes are held,
+    least recently used nodes are evicted. Paths are touched deepest node
+    first, so a node is always evicted before its ancestors.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.root = Node(None, None)
+        self.lru = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def path(self, ids):
+        """Returns the existing nodes for the prefixes x0, x0x1, ... of ids."""
+        nodes = []
+        node = self.root
+        for token in ids:
+            node = node.children.get(token)
+            if node is None:
+                break
+            nodes.append(node)
+        return nodes
+
+    def lookup(self, ids):
+        """Finds how much of a sentence can be resumed from the cache.
+
+        ids are the tokens x0..xn of a sentence whose inputs are x0..x(n-1).
+        Returns (m, rows, state): the rows of positions 0..m-1, and the state
+        from which to run the remaining inputs x(m)..x(n-1) (None for the
+        initial state). At least one input is always left to run.
+        """
+        nodes = self.path(ids)
+        m = max(0, min(len(nodes) - 1, len(ids) - 2))
+        while m > 0 and nodes[m-1].state is None:
+            m -= 1
+        self.touch(nodes)
+        self.hits += m
+        self.misses += len(ids) - 1 - m
+        return m, [node.row for node in nodes[1:m+1]], nodes[m-1].state if m > 0 else None
+
+    def insert(self, ids, rows, m, states):
+        """Adds the results of a sentence that was run from position m.
+
+        rows holds the rows of all positions 0..n-1 and states the states
+        after consuming x(m)..x(n-1).
+        """
+        nodes = self.path(ids)
+        node = nodes[-1] if nodes else self.root
+        for d in range(len(nodes), len(ids)):
+            child = Node(ids[d], node)
+            node.children[ids[d]] = child
+            nodes.append(child)
+            node = child
+        for d, node in enumerate(nodes):
+            if d >= 1 and node.row is None:
+                node.row = rows[d-1]
+            if m <= d < m + len(states) and node.state is None:
+                node.state = states[d-m]
+                size = sum(h.element_size() * h.nelement() for h in state_tensors(node.state))
+                node.nbytes += size
+                if id(node) in self.lru:
+                    self.nbytes += size
+            if id(node) not in self.lru:
+                self.lru[id(node)] = node
+                self.nbytes += node.nbytes
+        self.touch(nodes)
+        self.evict()
+
+    def touch(self, nodes):
+        for node in reversed(nodes):
+            if id(node) in self.lru:
+                self.lru.move_to_end(id(node))
+
+    def evict(self):
+        while self.nbytes > self.max_bytes and self.lru:
+            key, node = self.lru.popitem(last=False)
+            for child in list(node.children.values()):
+                # never reached while paths are touched deepest first
+                self.drop(child)
+            del node.parent.children[node.token]
+            self.nbytes -= node.nbytes
+            self.evictions += 1
+
+    def drop(self, node):
+        for child in list(node.children.values()):
+            self.drop(child)
+        del node.parent.children[node.token]
+        if self.lru.pop(id(node), None) is not None:
+            self.nbytes -= node.nbytes
+            self.evictions += 1
+
+    def report(self):
+        total = self.hits + self.misses
+        return ('prefix cache: {} hits, {} misses ({:.1%} of positions reused), {} nodes, '
+                '{:.1f} MB, {} evictions'.format(self.hits, self.misses, self.hits / max(total, 1),
+                                                 len(self.lru), self.nbytes / 2.0**20, self.evictions))
+
+def state_tensors(state):
+    if isinstance(state, tuple):
+        return state
+    return (state,)
@@ -0,0 +1,137 @@
+###############################################################################
+# Int8 export for CPU inference
+#
+# Dynamically quantizes a trained model (int8 weights for the recurrent
+# layers and Linear decoders, activations quantized on the fly) and saves it
+# as a traced TorchScript artifact, then reports how far its perplexity and
+# per-word surprisals on the validation set drift from the fp32 model:
+#
+#   python quantize.py --checkpoint model.pt --lm_data lm_data.bin --data ./data/wikitext-2 --out model.int8.pt
+#
+# Load the artifact with main.py --test --quantized --save model.int8.pt or
+# generate.py --quantized --checkpoint model.int8.pt.
+###############################################################################
+
+import argparse
+import json
+import math
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+import data
+from scorer import LanguageModelScorer
+
+def quantize(net):
+    """Returns a copy of net with int8 dynamically quantized LSTM/GRU and Linear layers."""
+    return torch.ao.quantization.quantize_dynamic(net, {nn.LSTM, nn.GRU, nn.Linear}, dtype=torch.qint8)
+
+class Traceable(nn.Module):
+    ## exposes both input paths of RNNModel as separately traced methods
+    def __init__(self, net):
+        super(Traceable, self).__init__()
+        self.net = net
+
+    def forward(self, input, hidden):
+        return self.net(input, hidden)
+
+    def forward_dist(self, input, hidden):
+        return self.net(input, hidden)
+
+def export(net, path):
+    """Traces an (eval mode) RNNModel and saves it as a TorchScript artifact.
+
+    Both the word id input path and the distribution input path used by
+    lookahead are traced; the settings init_hidden needs are stored next
+    to the code.
+    """
+    net.eval()
+    ntoken = net.encoder.num_embeddings
+    hidden = net.init_hidden(2)
+    ids = torch.zeros(3, 2, dtype=torch.long)
+    probs = torch.full((1, 2, ntoken), 1. / ntoken)
+    with torch.no_grad():
+        traced = torch.jit.trace_module(Traceable(net), {'forward': (ids, hidden),
+                                                         'forward_dist': (probs, hidden)})
+    config = {'rnn_type': net.rnn_type, 'nlayers': net.nlayers, 'nhid': net.nhid, 'ntoken': ntoken}
+    torch.jit.save(traced, path, _extra_files={'config.json': json.dumps(config)})
+
+class ScriptedModel(object):
+    """Runs an artifact written by export() behind the RNNModel interface used for evaluation."""
+    def __init__(self, module, config):
+        self.module = module
+        self.rnn_type = config['rnn_type']
+        self.nlayers = config['nlayers']
+        self.nhid = config['nhid']
+
+    def __call__(self, input, hidden, targets=None):
+        if input.is_floating_point():
+            output, hidden = self.module.forward_dist(input, hidden)
+        else:
+            output, hidden = self.module(input, hidden)
+        if targets is not None:
+            return nn.functional.cross_entropy(output.view(-1, output.size(2)), targets.contiguous().view(-1)), hidden
+        return output, hidden
+
+    def init_hidden(self, bsz):
+        weight = torch.zeros(self.nlayers, bsz, self.nhid)
+        if self.rnn_type == 'LSTM':
+            return (weight, weight.clone())
+        return weight
+
+    def eval(self):
+        self.module.eval()
+        return self
+
+def load(path):
+    """Loads an artifact written by export()."""
+    extra = {'config.json': ''}
+    module = torch.jit.load(path, map_location='cpu', _extra_files=extra)
+    return ScriptedModel(module, json.loads(extra['config.json']))
+
+def score_corpus(lm, sentences):
+    ## returns the per-word surprisals of all sentences and the scoring time
+    start = time.time()
+    results = lm.score(sentences)
+    elapsed = time.time() - start
+    return np.concatenate([r['surprisal'] for r in results]), elapsed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export an int8 quantized TorchScript LM and measure its accuracy')
+    parser.add_argument('--checkpoint', type=str, default='./model.pt',
+                        help='fp32 model checkpoint to quantize')
+    parser.add_argument('--lm_data', type=str, default='lm_data.bin',
+                        help='path of the LM data (aka vocab file)')
+    parser.add_argument('--data', type=str, default='./data/wikitext-2',
+                        help='location of the data corpus')
+    parser.add_argument('--validfname', type=str, default='valid.txt',
+                        help='name of the validation file')
+    parser.add_argument('--segmenter', type=str, default='punkt', choices=['punkt', 'regex', 'line'],
+                        help='sentence segmentation of the validation file (as main.py --segmenter)')
+    parser.add_argument('--out', type=str, default='model.int8.pt',
+                        help='path to save the quantized TorchScript artifact')
+    parser.add_argument('--batch_size', type=int, default=64,
+                        help='number of validation sentences scored per forward pass')
+    args = parser.parse_args()
+
+    lm = LanguageModelScorer(args.checkpoint, args.lm_data, batch_size=args.batch_size)
+    export(quantize(lm.model), args.out)
+    with data.open_text(os.path.join(args.data, args.validfname)) as f:
+        sentences = list(data.iter_sentences(f, args.segmenter))
+
+    fp32_surps, fp32_time = score_corpus(lm, sentences)
+    lm.model = load(args.out)
+    int8_surps, int8_time = score_corpus(lm, sentences)
+    delta = np.abs(int8_surps - fp32_surps)
+    print('=' * 89)
+    print('| fp32 valid ppl {:8.2f} | int8 valid ppl {:8.2f} | ppl change {:+6.2f}%'.format(
+        math.exp(fp32_surps.mean()), math.exp(int8_surps.mean()),
+        100 * (math.exp(int8_surps.mean() - fp32_surps.mean()) - 1)))
+    print('| per-word surprisal |change| mean {:.4f} | p99 {:.4f} | max {:.4f} nats'.format(
+        delta.mean(), np.percentile(delta, 99), delta.max()))
+    print('| scoring time fp32 {:.2f}s | int8 {:.2f}s | speedup {:.2f}x | {} words'.format(
+        fp32_time, int8_time, fp32_time / int8_time, len(delta)))
+    print('=' * 89)
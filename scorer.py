@@ -0,0 +1,154 @@
+###############################################################################
+# In-process scoring API
+#
+# LanguageModelScorer loads a trained model and its vocabulary once and then
+# answers scoring, next-word and beam search queries in batches, so other
+# programs can query the language model without spawning main.py or
+# generate.py and reloading the model for every request.
+#
+#   lm = LanguageModelScorer('model.pt', 'lm_data.bin')
+#   lm.score(['the horse raced past the barn fell'])
+#   lm.next_word_distribution('the horse raced past the', k=10)
+#   lm.beam_search('the horse', width=5)
+###############################################################################
+
+import torch
+import torch.nn as nn
+
+import data
+import checkpoint
+import complexity
+
+class LanguageModelScorer(object):
+    """Batched scoring, next-word prediction and beam search with one loaded model.
+
+    checkpoint_path is a model saved by main.py (either checkpoint format)
+    and lm_data the vocabulary file it was trained with. Sentences and
+    prefixes are whitespace-tokenized strings (or lists of words); like the
+    sentences of main.py --test, each is read as starting after an <eos>.
+    Words missing from the vocabulary are read as <unk>. At most batch_size
+    sentences go through the model per forward pass.
+    """
+    def __init__(self, checkpoint_path, lm_data, device='cpu', batch_size=64):
+        self.device = torch.device(device)
+        self.batch_size = batch_size
+        self.dictionary = data.load_dictionary(lm_data)
+        self.model, self.saved_state = checkpoint.load(checkpoint_path, map_location=self.device)
+        self.model.eval()
+        self.eos = self.dictionary.word2idx['<eos>']
+
+    def encode(self, sentence):
+        """Returns the ids of sentence (a string or a list of words), preceded by <eos>."""
+        words = sentence.split() if isinstance(sentence, str) else list(sentence)
+        ids = [self.eos]
+        for word in words:
+            if word in self.dictionary.word2idx:
+                ids.append(self.dictionary.word2idx[word])
+            elif '<unk>' in self.dictionary.word2idx:
+                ids.append(self.dictionary.word2idx['<unk>'])
+            else:
+                raise ValueError('{!r} is not in the vocabulary, which has no <unk>'.format(word))
+        return ids
+
+    def batches(self, seqs):
+        ## yields (indices, padded (seq_len, batch) ids, lengths) for
+        ## length-sorted groups of at most batch_size sequences
+        order = sorted(range(len(seqs)), key=lambda i: len(seqs[i]))
+        for start in range(0, len(order), self.batch_size):
+            ixes = order[start:start+self.batch_size]
+            lengths = [len(seqs[i]) for i in ixes]
+            batch = torch.zeros(max(lengths), len(ixes), dtype=torch.long)
+            for col, i in enumerate(ixes):
+                batch[:lengths[col], col] = torch.LongTensor(seqs[i])
+            yield ixes, batch.to(self.device), lengths
+
+    @torch.inference_mode()
+    def score(self, sentences):
+        """Scores whole sentences, including the final <eos>.
+
+        Returns one dict per sentence with the scored 'words' (ending in
+        <eos>), per-word 'surprisal' and 'entropy' lists (in nats, as in
+        main.py --test --words) and the total 'logprob' of the sentence.
+        """
+        seqs = [self.encode(s) + [self.eos] for s in sentences]
+        results = [None] * len(seqs)
+        for ixes, batch, lengths in self.batches(seqs):
+            output, hidden = self.model(batch[:-1], self.model.init_hidden(len(ixes)))
+            for col, i in enumerate(ixes):
+                targets = batch[1:lengths[col], col]
+                metrics = complexity.word_metrics(output[:lengths[col]-1, col], targets)
+                surps = metrics['surp'].tolist()
+                results[i] = {'words': [self.dictionary.idx2word[t] for t in seqs[i][1:]],
+                              'surprisal': surps,
+                              'entropy': metrics['entropy'].tolist(),
+                              'logprob': -sum(surps)}
+        return results
+
+    @torch.inference_mode()
+    def next_word_distribution(self, prefix, k=10):
+        """Returns the k most probable next words after prefix as (word, probability) pairs.
+
+        prefix may also be a list of prefixes, which are run as one batch
+        and get one list of pairs each.
+        """
+        single = isinstance(prefix, str)
+        prefixes = [prefix] if single else prefix
+        results = []
+        for start in range(0, len(prefixes), self.batch_size):
+            output, hidden = complexity.run_prefixes(self.model, [self.encode(p) for p in prefixes[start:start+self.batch_size]],
+                                                     self.device)
+            logprobs = nn.functional.log_softmax(output, dim=-1)
+            topk, topix = torch.topk(logprobs, min(k, logprobs.size(-1)), -1)
+            for probs, ixes in zip(topk.exp().tolist(), topix.tolist()):
+                results.append([(self.dictionary.idx2word[i], p) for i, p in zip(ixes, probs)])
+        return results[0] if single else results
+
+    @torch.inference_mode()
+    def beam_search(self, prefix, width=5, max_words=20):
+        """Finds likely continuations of prefix with a beam of the given width.
+
+        A hypothesis ends at <eos> or after max_words words. Returns up to
+        width (words, logprob) pairs, best first, where words excludes the
+        final <eos> and logprob is the unnormalized log probability of the
+        continuation. prefix may also be a list of prefixes, whose beams
+        all run as one batch and get one list of pairs each.
+        """
+        single = isinstance(prefix, str)
+        prefixes = [prefix] if single else prefix
+        nprefix = len(prefixes)
+        output, hidden = complexity.run_prefixes(self.model, [self.encode(p) for p in prefixes], self.device)
+        logprobs = nn.functional.log_softmax(output, dim=-1)
+        ntokens = logprobs.size(-1)
+        width = min(width, ntokens)
+        # beams of prefix b are rows b * width ... (b + 1) * width - 1
+        scores, words = torch.topk(logprobs, width, -1)
+        scores, words = scores.view(-1), words.view(-1)
+        rows = torch.arange(nprefix, device=self.device).repeat_interleave(width)
+        hidden = complexity.map_hidden(lambda h: h.index_select(1, rows), hidden)
+        history = words.unsqueeze(1)
+        finished = words == self.eos
+        for step in range(1, max_words):
+            if bool(finished.all()):
+                break
+            output, hidden = self.model(words.unsqueeze(0), hidden)
+            logprobs = nn.functional.log_softmax(output[0], dim=-1)
+            # a finished hypothesis can only be extended by a free <eos>
+            logprobs[finished] = float('-inf')
+            logprobs[finished, self.eos] = 0
+            candidates = (scores.unsqueeze(1) + logprobs).view(nprefix, width * ntokens)
+            scores, best = torch.topk(candidates, width, -1)
+            parents = (best // ntokens + torch.arange(nprefix, device=self.device).unsqueeze(1) * width).view(-1)
+            scores, words = scores.view(-1), (best % ntokens).view(-1)
+            hidden = complexity.map_hidden(lambda h: h.index_select(1, parents), hidden)
+            history = torch.cat([history.index_select(0, parents), words.unsqueeze(1)], 1)
+            finished = finished.index_select(0, parents) | (words == self.eos)
+        results = []
+        for b, (beams, beam_scores) in enumerate(zip(history.view(nprefix, width, -1).tolist(),
+                                                     scores.view(nprefix, width).tolist())):
+            hyps = []
+            for ids, score in zip(beams, beam_scores):
+                if self.eos in ids:
+                    ids = ids[:ids.index(self.eos)]
+                hyps.append(([self.dictionary.idx2word[i] for i in ids], score))
+            results.append(hyps)
+        return results[0] if single else results
@@ -0,0 +1,244 @@
+###############################################################################
+# Scoring server
+#
+# Keeps one model resident and scores sentences sent over HTTP on a local
+# TCP port or Unix socket, so each request skips the model, vocabulary and
+# NLTK loading of a fresh main.py --test process.
+#
+#   python server.py --checkpoint model.pt --lm_data lm_data.bin --socket /tmp/lm.sock
+#   curl --unix-socket /tmp/lm.sock -d '{"sentences": ["the horse raced"]}' http://lm/score
+#   curl --unix-socket /tmp/lm.sock http://lm/stats
+#
+# POST /score takes {"sentences": [...]} and returns {"results": [...]}, one
+# LanguageModelScorer.score dict (words, surprisal, entropy, logprob) per
+# sentence. Concurrent requests are coalesced into micro-batches of up to
+# --max_batch sentences; a batch waits at most --max_wait_ms for company
+# after its first request arrives. GET /stats reports the queue depth,
+# batch counts and p50/p99 request latency.
+###############################################################################
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import deque
+
+from scorer import LanguageModelScorer
+
+STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+          413: 'Payload Too Large', 500: 'Internal Server Error'}
+MAX_BODY = 1 << 24
+# pending connections accepted by the listening socket
+BACKLOG = 1024
+
+class BadRequest(Exception):
+    pass
+
+class ScoringServer(object):
+    """Micro-batching front end to a LanguageModelScorer.
+
+    Requests wait in a queue; a single batcher task takes the oldest,
+    waits up to max_wait seconds for more to fill max_batch sentences, and
+    scores the whole batch on a worker thread while new requests queue up.
+    """
+    def __init__(self, scorer, max_batch=64, max_wait=0.005, window=10000):
+        self.scorer = scorer
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = None
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.sentences = 0
+        self.batches = 0
+        self.in_flight = 0
+
+    async def score(self, sentences):
+        """Queues sentences for scoring and waits for their results."""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((sentences, future))
+        return await future
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            size = len(batch[0][0])
+            deadline = loop.time() + self.max_wait
+            while size < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                size += len(item[0])
+            self.in_flight = size
+            await loop.run_in_executor(None, self.run_batch, batch)
+            self.in_flight = 0
+            self.batches += 1
+
+    def run_batch(self, batch):
+        ## scores a batch on the worker thread and resolves its futures
+        sentences = [s for request, future in batch for s in request]
+        try:
+            results = self.scorer.score(sentences)
+        except Exception:
+            # score requests one at a time so only the bad ones fail
+            for request, future in batch:
+                self.run_batch_single(request, future)
+            return
+        start = 0
+        for request, future in batch:
+            self.resolve(future, results[start:start+len(request)])
+            start += len(request)
+
+    def run_batch_single(self, request, future):
+        try:
+            self.resolve(future, self.scorer.score(request))
+        except Exception as e:
+            self.resolve(future, e)
+
+    def resolve(self, future, result):
+        ## called from the worker thread
+        loop = future.get_loop()
+        if isinstance(result, Exception):
+            loop.call_soon_threadsafe(future.set_exception, result)
+        else:
+            loop.call_soon_threadsafe(future.set_result, result)
+
+    def percentile(self, q):
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    def stats(self):
+        p50, p99 = self.percentile(0.5), self.percentile(0.99)
+        return {'queue_depth': self.queue.qsize(),
+                'in_flight': self.in_flight,
+                'requests': self.requests,
+                'sentences': self.sentences,
+                'batches': self.batches,
+                'mean_batch': self.sentences / self.batches if self.batches else None,
+                'p50_ms': p50 * 1000 if p50 is not None else None,
+                'p99_ms': p99 * 1000 if p99 is not None else None}
+
+    async def handle(self, method, path, body):
+        ## returns (status, response object) for one request
+        if path == '/stats':
+            return 200, self.stats()
+        if path != '/score':
+            return 404, {'error': 'unknown path ' + path}
+        if method != 'POST':
+            return 405, {'error': '/score takes POST'}
+        start = time.time()
+        try:
+            sentences = json.loads(body.decode('utf-8'))['sentences']
+            if isinstance(sentences, str) or not all(isinstance(s, str) for s in sentences):
+                raise ValueError('"sentences" must be a list of strings')
+        except (ValueError, KeyError, TypeError) as e:
+            return 400, {'error': 'bad request: ' + str(e)}
+        try:
+            results = await self.score(sentences) if sentences else []
+        except ValueError as e:
+            return 400, {'error': str(e)}
+        except Exception as e:
+            return 500, {'error': '{}: {}'.format(type(e).__name__, e)}
+        self.latencies.append(time.time() - start)
+        self.requests += 1
+        self.sentences += len(sentences)
+        return 200, {'results': results}
+
+    async def connection(self, reader, writer):
+        ## serves the HTTP/1.1 requests of one (keep-alive) connection
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                try:
+                    method, path, version = request_line.decode('latin-1').split()
+                    headers = {}
+                    while True:
+                        line = await reader.readline()
+                        if line in (b'\r\n', b'\n', b''):
+                            break
+                        name, value = line.decode('latin-1').split(':', 1)
+                        headers[name.strip().lower()] = value.strip()
+                    length = int(headers.get('content-length', 0))
+                    if length > MAX_BODY:
+                        raise BadRequest(413)
+                except (ValueError, BadRequest) as e:
+                    status = e.args[0] if isinstance(e, BadRequest) else 400
+                    await self.respond(writer, status, {'error': STATUS[status]}, close=True)
+                    break
+                body = await reader.readexactly(length)
+                status, response = await self.handle(method, path.split('?')[0], body)
+                close = headers.get('connection', '').lower() == 'close' or version == 'HTTP/1.0'
+                await self.respond(writer, status, response, close)
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, response, close=False):
+        body = json.dumps(response).encode('utf-8')
+        head = 'HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'.format(
+            status, STATUS[status], len(body))
+        if close:
+            head += 'Connection: close\r\n'
+        writer.write(head.encode('latin-1') + b'\r\n' + body)
+        await writer.drain()
+
+    async def serve(self, socket_path=None, host='127.0.0.1', port=8000):
+        self.queue = asyncio.Queue()
+        batcher = asyncio.ensure_future(self.batcher())
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = await asyncio.start_unix_server(self.connection, path=socket_path, backlog=BACKLOG)
+            sys.stderr.write('Listening on ' + socket_path + '\n')
+        else:
+            server = await asyncio.start_server(self.connection, host, port, backlog=BACKLOG)
+            sys.stderr.write('Listening on {}:{}\n'.format(host, port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            if socket_path is not None and os.path.exists(socket_path):
+                os.remove(socket_path)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve sentence scores from a trained LM')
+    parser.add_argument('--checkpoint', type=str, default='./model.pt',
+                        help='model checkpoint to use')
+    parser.add_argument('--lm_data', type=str, default='lm_data.bin',
+                        help='path of the LM data (aka vocab file)')
+    parser.add_argument('--socket', type=str, default=None,
+                        help='Unix socket to listen on (default: TCP on --host/--port)')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='TCP address to listen on')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='TCP port to listen on')
+    parser.add_argument('--max_batch', type=int, default=64,
+                        help='most sentences scored per micro-batch')
+    parser.add_argument('--max_wait_ms', type=float, default=5,
+                        help='longest a micro-batch waits for more requests')
+    parser.add_argument('--cuda', action='store_true',
+                        help='use CUDA')
+    args = parser.parse_args()
+
+    scorer = LanguageModelScorer(args.checkpoint, args.lm_data, device='cuda' if args.cuda else 'cpu',
+                                 batch_size=args.max_batch)
+    server = ScoringServer(scorer, args.max_batch, args.max_wait_ms / 1000.)
+    try:
+        asyncio.run(server.serve(args.socket, args.host, args.port))
+    except KeyboardInterrupt:
+        sys.stderr.write(json.dumps(server.stats()) + '\n')
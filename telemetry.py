@@ -0,0 +1,204 @@
+###############################################################################
+# Telemetry
+#
+# Breaks the time of training and testing down into phases, counts tokens
+# and sentences, and writes one record per reporting interval, either as a
+# JSON line appended to a log or as a Prometheus textfile (for the
+# node_exporter textfile collector) rewritten in place:
+#
+#   python main.py --telemetry train.jsonl ...
+#   python main.py --telemetry /var/lib/node_exporter/lm.prom --telemetry_format prom ...
+#
+# Phases:
+#   slice    slicing bptt chunks of the corpus (BPTTIterator thread)
+#   copy     host to device copies (BPTTIterator thread, GPU only)
+#   wait     time the training loop waited for the next chunk
+#   forward  embedding and recurrent layers
+#   loss     decoder, softmax and loss
+#   backward, clip, update
+#   output   writing test results
+# slice and copy run in a background thread and overlap the others; wall_s
+# is the elapsed time of the interval. On a GPU, phases synchronize the
+# device at their boundaries, which makes them exact but a little slower.
+###############################################################################
+
+import contextlib
+import json
+import os
+import resource
+import sys
+import time
+
+import torch
+
+def peak_rss_mb():
+    """Returns the peak resident set size of this process in MB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / (2.**20 if sys.platform == 'darwin' else 2.**10)
+
+class Telemetry(object):
+    """Phase timers and counters, reported every interval to path.
+
+    With path None every method is a cheap no-op, so the instrumented
+    loops cost nothing when telemetry is off.
+    """
+    def __init__(self, path=None, fmt='jsonl', sync=False):
+        self.path = path
+        self.fmt = fmt
+        self.enabled = path is not None
+        self.sync = sync and torch.cuda.is_available()
+        # the last record of each stage, for the Prometheus textfile
+        self.latest = {}
+        self.reset()
+
+    def reset(self):
+        self.seconds = {}
+        self.counts = {}
+        self.started = {}
+        self.interval_start = time.time()
+
+    def now(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def start(self, name):
+        if self.enabled:
+            self.started[name] = self.now()
+
+    def stop(self, name):
+        if self.enabled and name in self.started:
+            self.add(name, self.now() - self.started.pop(name))
+
+    def add(self, name, seconds):
+        self.seconds[name] = self.seconds.get(name, 0.) + seconds
+
+    def phase(self, name):
+        """Returns a context manager that adds its duration to phase name."""
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self.timed(name)
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.add(name, self.now() - start)
+
+    def iterate(self, iterable, name):
+        """Yields the items of iterable, adding the time spent waiting for each to phase name."""
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(name, time.perf_counter() - start)
+            yield item
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def counted(self, name):
+        """Returns the count of name in the current interval (0 with telemetry off)."""
+        return self.counts.get(name, 0)
+
+    def instrument(self, net):
+        """Splits the forward passes of an RNNModel into forward and loss phases with hooks."""
+        if self.enabled:
+            net.register_forward_pre_hook(lambda module, input: self.start('forward'))
+            net.rnn.register_forward_hook(self.recurrent_done)
+            net.register_forward_hook(lambda module, input, output: self.stop('loss'))
+
+    def recurrent_done(self, module, input, output):
+        ## a forward hook must return None, or it replaces the output
+        self.stop('forward')
+        self.start('loss')
+
+    def report(self, stage, **fields):
+        """Writes a record of the interval since the last report and starts a new one."""
+        if not self.enabled:
+            return
+        wall = time.time() - self.interval_start
+        record = {'time': time.time(), 'stage': stage, 'wall_s': wall,
+                  'phases': dict((name, round(s, 6)) for name, s in sorted(self.seconds.items())),
+                  'peak_rss_mb': round(peak_rss_mb(), 1)}
+        for name, n in sorted(self.counts.items()):
+            record[name] = n
+            record[name + '_per_s'] = n / wall if wall > 0 else None
+        record.update(fields)
+        if self.fmt == 'prom':
+            self.write_prom(record)
+        else:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        self.reset()
+
+    def write_prom(self, record):
+        ## rewrites the textfile atomically with the latest record of each stage
+        self.latest[record['stage']] = record
+        lines = ['# HELP lm_phase_seconds Seconds spent in each phase during the last interval.',
+                 '# TYPE lm_phase_seconds gauge']
+        for stage, rec in sorted(self.latest.items()):
+            for name, s in rec['phases'].items():
+                lines.append('lm_phase_seconds{{stage="{}",phase="{}"}} {}'.format(stage, name, s))
+        for metric, key, help in [('lm_interval_seconds', 'wall_s', 'Elapsed seconds of the last interval.'),
+                                  ('lm_tokens_per_second', 'tokens_per_s', 'Tokens processed per second.'),
+                                  ('lm_sentences_per_second', 'sentences_per_s', 'Sentences processed per second.'),
+                                  ('lm_loss', 'loss', 'Mean loss over the last interval.')]:
+            values = [(stage, rec[key]) for stage, rec in sorted(self.latest.items()) if rec.get(key) is not None]
+            if values:
+                lines.append('# HELP {} {}'.format(metric, help))
+                lines.append('# TYPE {} gauge'.format(metric))
+                lines.extend('{}{{stage="{}"}} {}'.format(metric, stage, v) for stage, v in values)
+        lines.append('# HELP lm_peak_rss_bytes Peak resident set size of the process.')
+        lines.append('# TYPE lm_peak_rss_bytes gauge')
+        lines.append('lm_peak_rss_bytes {:.0f}'.format(record['peak_rss_mb'] * 2**20))
+        tmp = self.path + '.tmp' + str(os.getpid())
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, self.path)
+
+class Profiler(object):
+    """A torch.profiler window of steps steps, starting after skip steps.
+
+    The trace is written to path in Chrome trace format (open it in
+    chrome://tracing or Perfetto) and a table of the most expensive
+    operators goes to stderr. With steps 0 it does nothing.
+    """
+    def __init__(self, path, steps, skip=0, cuda=False):
+        self.prof = None
+        if steps > 0:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.path = path
+            self.cuda = cuda
+            self.prof = torch.profiler.profile(activities=activities,
+                                               schedule=torch.profiler.schedule(wait=skip, warmup=1, active=steps, repeat=1),
+                                               on_trace_ready=self.trace_ready,
+                                               record_shapes=True, profile_memory=True)
+            self.prof.start()
+
+    def trace_ready(self, prof):
+        prof.export_chrome_trace(self.path)
+        sort_by = 'self_cuda_time_total' if self.cuda else 'self_cpu_time_total'
+        sys.stderr.write(prof.key_averages().table(sort_by=sort_by, row_limit=20) + '\n')
+        sys.stderr.write('Profiler trace saved to ' + self.path + '\n')
+
+    def step(self):
+        if self.prof is not None:
+            self.prof.step()
+
+    def stop(self):
+        if self.prof is not None:
+            self.prof.stop()
+            self.prof = None
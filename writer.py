@@ -0,0 +1,150 @@
+###############################################################################
+# Complexity output writers
+#
+# Writers take the metrics of a whole sentence at once. Each metric tensor is
+# moved to the CPU with a single tolist() call, the rows are formatted in
+# bulk and the sentence is written in one call to a large buffered stream,
+# so output costs no per-word device syncs or print() calls.
+###############################################################################
+
+import io
+import sys
+import numpy as np
+import torch.nn as nn
+
+BUFFER_SIZE = 1 << 20
+
+def open_writer(path, fmt, idx2word, words=False, guessn=0, guessmode=None, hallucinated=False):
+    """Returns a writer for test output.
+
+    path is the output file (None for stdout) and fmt either 'txt' for the
+    space-separated text format or 'npz' for binary columns. guessmode picks
+    the value printed after each guess: 'scores', 'ratios', 'probs' or None.
+    """
+    if fmt == 'npz':
+        if path is None:
+            raise ValueError('npz output needs an output file')
+        return NpzWriter(path, idx2word, words, guessn)
+    if path is None:
+        sys.stdout.flush()
+        stream = io.open(sys.stdout.fileno(), 'w', buffering=BUFFER_SIZE, closefd=False)
+    else:
+        stream = io.open(path, 'w', buffering=BUFFER_SIZE)
+    return TextWriter(stream, idx2word, words, guessn, guessmode, hallucinated)
+
+class TextWriter(object):
+    """Writes the space-separated word-level rows (or sentence:loss lines)."""
+    def __init__(self, stream, idx2word, words=False, guessn=0, guessmode=None, hallucinated=False):
+        self.stream = stream
+        self.idx2word = idx2word
+        self.words = words
+        self.guessn = guessn
+        self.guessmode = guessmode
+        self.hallucinated = hallucinated
+        if words:
+            self.write_header()
+
+    def write_header(self):
+        header = 'word sentid sentpos wlen surp entropy entred'
+        if self.hallucinated:
+            header += ' hallent'
+        for i in range(self.guessn):
+            header += ' guess'+str(i)
+            if self.guessmode == 'scores':
+                header += ' gscore'+str(i)
+        self.stream.write(header+'\n')
+
+    def write_sentence(self, sentid, text, loss):
+        self.stream.write(str(text)+':'+str(loss)+'\n')
+
+    def write_words(self, sentid, targets, metrics):
+        idx2word = self.idx2word
+        targets = targets.tolist()
+        surps = metrics['surp'].tolist()
+        Hs = metrics['entropy'].tolist()
+        if self.hallucinated:
+            hallucinated = metrics['hallucinated'].tolist()
+        if self.guessn > 0:
+            guesses = metrics['guesses'].tolist()
+            guessscores = metrics['guessscores'].tolist()
+            if self.guessmode == 'probs':
+                ## Currently normalizes probs over N-best list; ideally it'd normalize to probs before getting the N-best
+                guessprobs = nn.functional.softmax(metrics['guessscores'], dim=1).tolist()
+        sentid = str(sentid)
+        rows = []
+        for corpuspos, targ in enumerate(targets):
+            word = idx2word[targ]
+            if word == '<eos>':
+                #don't output the complexity of EOS
+                continue
+            fields = [word, sentid, str(corpuspos), str(len(word)), str(surps[corpuspos]), str(Hs[corpuspos]),
+                      str(max(0, Hs[corpuspos]-Hs[max(corpuspos-1, 0)]))]
+            if self.hallucinated:
+                fields.append(str(hallucinated[corpuspos]))
+            for g in range(self.guessn):
+                fields.append(idx2word[guesses[corpuspos][g]])
+                if self.guessmode == 'scores':
+                    ##output raw scores
+                    fields.append('{:.3f}'.format(guessscores[corpuspos][g]))
+                elif self.guessmode == 'ratios':
+                    ##output scores (ratio of score(x)/score(best guess)
+                    fields.append('{:.3f}'.format(guessscores[corpuspos][g]/guessscores[corpuspos][0]))
+                elif self.guessmode == 'probs':
+                    ##output probabilities
+                    fields.append('{:.3f}'.format(guessprobs[corpuspos][g]))
+            rows.append(' '.join(fields))
+        if rows:
+            self.stream.write('\n'.join(rows)+'\n')
+
+    def close(self):
+        # flushes, but leaves a shared stdout open
+        self.stream.flush()
+        if self.stream.fileno() != sys.stdout.fileno():
+            self.stream.close()
+
+class NpzWriter(object):
+    """Collects output columns and saves them to a compressed .npz archive.
+
+    Word-level archives hold one entry per output row: word (vocabulary id),
+    sentid, sentpos, surp, entropy and entred, plus hallent, guesses and
+    guessscores when computed, with the vocabulary itself in idx2word.
+    Sentence-level archives hold sentid and loss.
+    """
+    def __init__(self, path, idx2word, words=False, guessn=0):
+        self.path = path
+        self.idx2word = idx2word
+        self.words = words
+        self.guessn = guessn
+        self.eos = idx2word.index('<eos>') if words else None
+        self.columns = {}
+
+    def append(self, name, values):
+        self.columns.setdefault(name, []).append(values)
+
+    def write_sentence(self, sentid, text, loss):
+        self.append('sentid', np.array([sentid], dtype=np.int64))
+        self.append('loss', np.array([loss], dtype=np.float64))
+
+    def write_words(self, sentid, targets, metrics):
+        targets = targets.detach().cpu().numpy()
+        Hs = metrics['entropy'].detach().cpu().numpy()
+        # entropy reduction against the previous position, as in the text output
+        entred = np.maximum(0, Hs - np.concatenate([Hs[:1], Hs[:-1]]))
+        keep = targets != self.eos
+        self.append('word', targets[keep].astype(np.int32))
+        self.append('sentid', np.full(int(keep.sum()), sentid, dtype=np.int64))
+        self.append('sentpos', np.flatnonzero(keep).astype(np.int32))
+        self.append('surp', metrics['surp'].detach().cpu().numpy()[keep])
+        self.append('entropy', Hs[keep])
+        self.append('entred', entred[keep])
+        if 'hallucinated' in metrics:
+            self.append('hallent', metrics['hallucinated'].detach().cpu().numpy()[keep])
+        if self.guessn > 0:
+            self.append('guesses', metrics['guesses'].detach().cpu().numpy()[keep].astype(np.int32))
+            self.append('guessscores', metrics['guessscores'].detach().cpu().numpy()[keep])
+
+    def close(self):
+        columns = dict((name, np.concatenate(values)) for name, values in self.columns.items())
+        if self.words:
+            columns['idx2word'] = np.array(list(self.idx2word))
+        np.savez_compressed(self.path, **columns)